@@ -1,23 +1,92 @@
+import time
+
+from datetime import datetime
+from threading import Event
+from typing import Optional, Tuple
 from mcdreforged.api.all import *
 
-from .utils import tr
-from .config import config
+from .utils import tr, debug_log, ign
+from .config import config, load_config
 from .storage import storage
-from .sessions import AbstractSession, AutoMapRollingSession, LoadSlotSession
+from .metrics import exporter
+from .players import player_tracker
+from .staging import slot_stager
+from .sessions import AbstractSession, AutoMapRollingSession, LoadSlotSession, roll_when_idle
 from .core import register_command, roller
+from .switch_queue import switch_queue
+
+
+unloaded = Event()
+# Read by the next instance of this plugin, so a reload doesn't restart the rotation
+rolling_clock: Optional[Tuple[datetime, datetime]] = None
 
 
 def on_unload(*args, **kwargs):
+    global rolling_clock
+    unloaded.set()
+    rolling: Optional[AutoMapRollingSession] = AutoMapRollingSession.get_instance()
+    if rolling is not None and rolling.is_running:
+        rolling_clock = rolling.clock
+    switch_queue.stop()
     AbstractSession.on_unload()
+    slot_stager.shutdown()
+    exporter.stop()
+
+
+@new_thread('MapSwitcher_InitialScan')
+def initial_scan(server: PluginServerInterface, clock: Optional[Tuple[datetime, datetime]] = None):
+    # Staged copies left by a former instance are never complete enough to be trusted
+    result = ign(slot_stager.discard_all)
+    if result is not True:
+        server.logger.warning(f'Failed to clean staging folder: {result}')
+    scan_start = time.time()
+    storage.rescan()
+    if LoadSlotSession.current_slot is None:
+        LoadSlotSession.current_slot = storage.current_slot
+    slots_amount = len(storage.get_slots_info())
+    server.logger.info(f'Found {slots_amount} map(s) in {round((time.time() - scan_start) * 1000, 1)} ms')
+    if unloaded.is_set():
+        return
+    if slots_amount <= 1:
+        server.logger.warning("Auto rolling didn't start because not adequate map to switch")
+        server.logger.warning("Reload this plugin after loaded 2 or more maps")
+    elif AutoMapRollingSession.get_instance() is None:
+        AutoMapRollingSession(roller, clock=clock).set_session()
+        debug_log('Auto rolling started after initial scan')
 
 
 def on_load(server: PluginServerInterface, prev_module):
+    load_start = time.time()
+    load_config()
     server.register_help_message(config.primary_prefix, tr('help.mcdr'))
     register_command()
+    exporter.start()
+    player_tracker.add_idle_listener(roll_when_idle)
+    player_tracker.register_idle_task('rescan_slots', storage.rescan)
+    player_tracker.register_idle_task('index_slots', storage.index_slots)
     if prev_module is not None:
         LoadSlotSession.current_slot = prev_module.LoadSlotSession.current_slot
-    if len(storage.get_slots_info()) <= 1:
-        server.logger.warning("Auto rolling didn't start because not adequate map to switch")
-        server.logger.warning("Reload this plugin after loaded 2 or more maps")
-    else:
-        AutoMapRollingSession(roller).set_session()
+    player_tracker.inherit(getattr(prev_module, 'player_tracker', None))
+    player_tracker.request_sync()
+    initial_scan(server, getattr(prev_module, 'rolling_clock', None))
+    server.logger.info(f'Load phase finished in {round((time.time() - load_start) * 1000, 1)} ms')
+
+
+def on_info(server: PluginServerInterface, info: Info):
+    player_tracker.on_info(info)
+
+
+def on_player_joined(server: PluginServerInterface, player: str, info: Info):
+    player_tracker.on_join(player)
+
+
+def on_player_left(server: PluginServerInterface, player: str):
+    player_tracker.on_leave(player)
+
+
+def on_server_startup(server: PluginServerInterface):
+    player_tracker.on_server_startup()
+
+
+def on_server_stop(server: PluginServerInterface, return_code: int):
+    player_tracker.on_server_stop()
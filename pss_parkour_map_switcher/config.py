@@ -1,17 +1,58 @@
+import re
+
+from functools import lru_cache
 from mcdreforged.api.utils import Serializable
 from mcdreforged.api.types import ServerInterface, PluginServerInterface
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Tuple
 
 gl_server: PluginServerInterface = ServerInterface.get_instance().as_plugin_server_interface()
 
 
 class PermissionRequirements(Serializable):
     reload: int = 3
+    config: int = 3
     vote_for_next: int = 3
     select: int = 1
     list: int = 1
     info: int = 1
     settle: int = 3
+    switch: int = 3
+    import_slots: int = 3
+    optimize: int = 3
+
+
+class StagingConfig(Serializable):
+    enabled: bool = False  # copies slots into the server folder while votes are running
+    folder: str = 'pms_staging'
+    max_staged_slots: int = 2
+    budget_mb: float = 2048.0
+
+
+class OptimizeConfig(Serializable):
+    min_inhabited_ticks: int = 0  # chunks inhabited for less ticks are removed, 0 to disable
+    # chunks holding nothing but air are removed, only in flat or void dimensions as others generate terrain there again
+    drop_empty_chunks: bool = True
+    bounding_box: Optional[List[int]] = None  # [x1, z1, x2, z2] in block coordinates, chunks outside are removed
+
+
+class WorldCacheConfig(Serializable):
+    # Keep recently used slots materialized under server_path and switch by rewriting level-name,
+    # cached worlds keep the changes made while being played
+    enabled: bool = False
+    prefix: str = 'pms_cache_'
+    budget_mb: float = 8192.0
+
+
+class DataVersionConfig(Serializable):
+    check: bool = True  # slots saved by another game version are never selected
+    server_data_version: Optional[int] = None  # read from the live world if None
+    allow_older: bool = False  # let the server upgrade slots saved by an older version
+
+
+class MetricsConfig(Serializable):
+    enabled: bool = False
+    textfile_path: str = './metrics/pss_parkour_map_switcher.prom'
+    write_interval: float = 15.0  # second(s)
 
 
 class Configuration(Serializable):
@@ -20,12 +61,18 @@ class Configuration(Serializable):
     server_path: str = './server'
     countdown_time: int = 5
     max_slots: int = 10
+    list_page_size: int = 10
     vote_time_limit: float = 2.0  # min(s)
     map_rolling_interval: float = 60.0  # min(s)
     remind_rolling_interval: float = 10  # min(s)
+    idle_rolling_after: float = 15.0  # min(s), roll at once when server gets empty after this, negative to disable
+    idle_maintenance: bool = True
     slots_percentage_allowed_in_random: float = 50.0  # %
     restore_temp_folder: str = 'temp'
+    import_folder: str = './map_imports'
+    import_workers: int = 2
     default_delay_single_time: int = 10
+    session_workers: int = 4
     world_names: List[str] = [
         'world'
     ]
@@ -34,9 +81,15 @@ class Configuration(Serializable):
     ]
     current_slot: Optional[str] = None
     permission_requirements: PermissionRequirements = PermissionRequirements.get_default()
+    staging: StagingConfig = StagingConfig.get_default()
+    optimize: OptimizeConfig = OptimizeConfig.get_default()
+    world_cache: WorldCacheConfig = WorldCacheConfig.get_default()
+    data_version: DataVersionConfig = DataVersionConfig.get_default()
+    metrics: MetricsConfig = MetricsConfig.get_default()
 
     __debug_perm = 4
-    __debug_nodes = ['session-status']
+    __debug_nodes = ['session-status', 'simulate', 'switch-queue', 'profile']
+    __perm_aliases = {'import': 'import_slots'}
 
     @property
     def prefix(self) -> List[str]:
@@ -49,6 +102,7 @@ class Configuration(Serializable):
     def get_prem(self, literal: str) -> int:
         if literal in self.__debug_nodes:
             return self.__debug_perm
+        literal = self.__perm_aliases.get(literal, literal)
         return self.permission_requirements.serialize().get(literal, 1)
 
     @classmethod
@@ -64,6 +118,24 @@ class Configuration(Serializable):
         if cfg.countdown_time <= 0:
             cfg.slots_percentage_allowed_in_random = default.slots_percentage_allowed_in_random
             illegal_item.append('count down time (must >0)')
+        if cfg.list_page_size <= 0:
+            cfg.list_page_size = default.list_page_size
+            illegal_item.append('list page size (must >0)')
+        if cfg.session_workers <= 0:
+            cfg.session_workers = default.session_workers
+            illegal_item.append('session worker amount (must >0)')
+        if cfg.import_workers <= 0:
+            cfg.import_workers = default.import_workers
+            illegal_item.append('import worker amount (must >0)')
+        if cfg.staging.max_staged_slots <= 0:
+            cfg.staging.max_staged_slots = default.staging.max_staged_slots
+            illegal_item.append('max staged slot amount (must >0)')
+        if cfg.world_cache.prefix == '' or not cfg.world_cache.prefix.isidentifier():
+            cfg.world_cache.prefix = default.world_cache.prefix
+            illegal_item.append('world cache prefix (letters, digits and underscores only)')
+        if cfg.metrics.write_interval <= 0:
+            cfg.metrics.write_interval = default.metrics.write_interval
+            illegal_item.append('metrics write interval (must >0)')
 
         if len(illegal_item) != 0:
             cfg.save()
@@ -75,16 +147,37 @@ class Configuration(Serializable):
     def save(self):
         gl_server.save_config_simple(self)
 
+    def update_from(self, other: 'Configuration') -> List[str]:
+        changed, new_values = [], other.serialize()
+        old_values = self.serialize()
+        for key in self.get_field_annotations().keys():
+            if old_values.get(key) != new_values.get(key):
+                changed.append(key)
+            setattr(self, key, getattr(other, key))
+        return changed
+
     def is_file_ignored(self, file_name: str) -> bool:
-        for item in self.ignored_files:
-            if len(item) > 0:
-                if item[0] == '*' and file_name.endswith(item[1:]):
-                    return True
-                if item[-1] == '*' and file_name.startswith(item[:-1]):
-                    return True
-                if file_name == item:
-                    return True
-        return False
-
-
-config: Configuration = Configuration.load()
+        pattern = compile_ignore_patterns(tuple(self.ignored_files))
+        return pattern is not None and pattern.fullmatch(file_name) is not None
+
+
+@lru_cache(maxsize=4)
+def compile_ignore_patterns(patterns: Tuple[str, ...]) -> Optional['re.Pattern']:
+    # "*suffix", "prefix*" or exact names, compiled once per distinct ignored_files value
+    rules = []
+    for item in patterns:
+        if len(item) > 0:
+            if item[0] == '*':
+                rules.append('.*' + re.escape(item[1:]))
+            if item[-1] == '*':
+                rules.append(re.escape(item[:-1]) + '.*')
+            rules.append(re.escape(item))
+    return re.compile('|'.join(rules), re.DOTALL) if len(rules) > 0 else None
+
+
+# Filled in place by load_config() in on_load, so modules holding this reference see the loaded values
+config: Configuration = Configuration.get_default()
+
+
+def load_config() -> List[str]:
+    return config.update_from(Configuration.load())
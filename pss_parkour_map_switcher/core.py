@@ -4,11 +4,21 @@ from typing import Union, Iterable, List, Optional
 from mcdreforged.api.types import CommandSource, PlayerCommandSource
 from mcdreforged.api.rtext import *
 from mcdreforged.api.command import *
+from mcdreforged.api.decorator import new_thread
 
-from .storage import storage
-from .utils import gl_server, tr, DEBUG, src_name, debug_log
+from .storage import storage, SORT_KEYS
+from .utils import gl_server, tr, DEBUG, src_name, debug_log, format_size
 from .sessions import AbstractSession, LoadSlotSession, VoteSession, VoteOption, AutoMapRollingSession
-from .config import config
+from .config import config, load_config
+from .executor import session_executor
+from .metrics import exporter
+from .level import data_version_checker
+from .importer import importer
+from .staging import slot_stager
+from .region import region_optimizer
+from .simulator import rotation_simulator
+from .switch_queue import switch_queue, SwitchRequest, SwitchPriority
+from .profiler import session_profiler
 
 
 def htr(key: str, *args, **kwargs) -> Union[str, RTextBase]:
@@ -47,21 +57,29 @@ def start_vote_to_switch(source: CommandSource):
         if result.actual_name == 'keep':
             gl_server.say(tr('msg.kept'))
             return
-        current: LoadSlotSession = LoadSlotSession.get_instance()
-        if current is not None:
-            current.interrupt()
-        current: AutoMapRollingSession = AutoMapRollingSession.get_instance()
-        if current is not None:
-            current.interrupt()
-        load_session = LoadSlotSession(result.actual_name, handle_exc=False, should_lock=False)
-        load_session.start()
-
-    slots = list(storage.get_slots_info().keys())
+        switch_queue.submit(SwitchRequest(SwitchPriority.VOTE, result.actual_name, src_name(source)))
+
+    slots = [item for item in storage.get_slots_info().keys() if storage.is_slot_compatible(item)]
     if LoadSlotSession.current_slot in slots:
         slots.remove(LoadSlotSession.current_slot)
     options = [VoteOption(item) for item in slots]
     options.append(VoteOption('keep', tr('msg.switch_options.keep'), color=RColor.gold))
-    VoteSession(src_name(source), options, switch_handler, tr('msg.switch_options.target'))
+    VoteSession(
+        src_name(source), options, switch_handler, tr('msg.switch_options.target'),
+        progress_listener=stage_leading_options
+    )
+
+
+def stage_leading_options(vote: VoteSession):
+    if vote.terminated:
+        slot_stager.retain([item.actual_name for item in vote.winners if item.actual_name != 'keep'])
+        return
+    leading = [
+        option.actual_name for option, count in vote.vote_result.items() if count > 0 and option.actual_name != 'keep'
+    ]
+    # Keep what is staged until somebody votes for a slot
+    if len(leading) > 0:
+        slot_stager.retain(leading)
 
 
 def start_vote_to_delay_rolling(source: CommandSource, delay_time: Optional[int] = None):
@@ -73,6 +91,9 @@ def start_vote_to_delay_rolling(source: CommandSource, delay_time: Optional[int]
         result = result[0]
         if result.actual_name == 'delay':
             rolling: AutoMapRollingSession = AutoMapRollingSession.get_instance()
+            # Rolling may have fired during the vote, its switch waits in the queue until the vote ends
+            if not rolling.is_running and not switch_queue.withdraw(SwitchPriority.AUTO):
+                raise RuntimeError("Can't delay a finished session")
             rolling.delay(delay_time)
             gl_server.say(tr('msg.delay.delayed', delay_time))
         elif result.actual_name == 'keep':
@@ -90,35 +111,109 @@ def reload_self(source: CommandSource):
     source.reply(tr('msg.reloaded'))
 
 
-def list_worlds(source: CommandSource):
-    slots = storage.get_slots_info()
-    slots_amount, num = len(slots), 0
-    text_list = [tr('msg.list.title', slots_amount)]
-    for slot_name in slots.keys():
-        num += 1
+def reload_config(source: CommandSource):
+    former_prefix = config.prefix
+    changed = load_config()
+    debug_log(f'Changed config keys: {", ".join(changed)}')
+    # Command tree can't be patched in place, a full reload hands the rotation clock over instead
+    if set(config.prefix) != set(former_prefix):
+        source.reply(tr('msg.config_reloaded_with_plugin'))
+        reload_self(source)
+        return
+    if 'map_rolling_interval' in changed or 'remind_rolling_interval' in changed:
+        rolling: Optional[AutoMapRollingSession] = AutoMapRollingSession.get_instance()
+        if rolling is not None:
+            rolling.reschedule()
+    if 'data_version' in changed or 'server_path' in changed:
+        data_version_checker.forget()
+    if 'session_workers' in changed:
+        session_executor.refresh()
+    if 'backup_path' in changed:
+        storage.reset()
+        rescan_storage()
+    if 'staging' in changed and not config.staging.enabled:
+        slot_stager.discard_all()
+    if 'metrics' in changed:
+        if config.metrics.enabled:
+            exporter.start()
+        else:
+            exporter.stop()
+    source.reply(tr('msg.config_reloaded', len(changed)))
+
+
+@new_thread('MapSwitcher_Rescan')
+def rescan_storage():
+    storage.rescan()
+
+
+@new_thread('MapSwitcher_Import')
+def import_slots(source: CommandSource):
+    importer.run(source)
+
+
+@new_thread('MapSwitcher_Optimize')
+def optimize_slot(source: CommandSource, slot_name: str, confirmed: bool = False):
+    region_optimizer.run(source, slot_name, confirmed)
+
+
+def list_worlds(source: CommandSource, page: int = 1, sort: str = 'last_used', keyword: Optional[str] = None):
+    slots = storage.list_slots(sort.lstrip('-'), sort.startswith('-'), keyword)
+    page_size = config.list_page_size
+    pages = max((len(slots) + page_size - 1) // page_size, 1)
+    if not 1 <= page <= pages:
+        source.reply(tr('error.invalid_page', pages))
+        return
+    if keyword is not None and len(slots) == 0:
+        source.reply(tr('msg.list.no_match', keyword))
+        return
+    text_list = [tr('msg.list.title', len(slots))]
+    # Only this page gets RText built, however large the catalog is
+    for num in range((page - 1) * page_size, min(page * page_size, len(slots))):
+        slot_name = slots[num]
         text_list.append(
             RText(
-                f'[§7{num}] §b{slot_name}§r'
+                f'[§7{num + 1}] §b{slot_name}§r'
             ).h(
                 tr('hover.list.info', slot_name)
             ).c(
                 RAction.run_command, f"{config.primary_prefix} info {slot_name}"
             )
         )
+    if pages > 1:
+        def page_button(text: str, target: int, enabled: bool) -> RTextBase:
+            if not enabled:
+                return RText(text, RColor.dark_gray)
+            command = f'{config.primary_prefix} list {target} {sort}'
+            if keyword is not None:
+                command += ' "{}"'.format(keyword.replace('\\', '\\\\').replace('"', '\\"'))
+            return RText(text, RColor.aqua).h(tr('hover.list.page', target)).c(RAction.run_command, command)
+
+        text_list.append(RTextList(
+            page_button('[<]', page - 1, page > 1), ' ', tr('msg.list.page', page=page, pages=pages, sort=sort),
+            ' ', page_button('[>]', page + 1, page < pages)
+        ))
     source.reply(RTextBase.join('\n', text_list))
 
 
-def info_slot(source: CommandSource, slot_name: str):
-    def format_size(size: int):
-        if size < 2 ** 30:
-            return f'{round(size / 2 ** 20, 2)} §6MB'
-        else:
-            return f'{round(size / 2 ** 30, 2)} §6GB'
+def is_valid_sort(sort: str) -> bool:
+    return sort.lstrip('-') in SORT_KEYS
+
 
+def info_slot(source: CommandSource, slot_name: str):
     slot_info = storage.get_slots_info().get(slot_name)
-    source.reply(
-        tr('msg.info', slot_name=slot_name, slot_info=slot_info, size=format_size(storage.get_slot_size(slot_name)))
-    )
+    text = RTextList(tr(
+        'msg.info', slot_name=slot_name, slot_info=slot_info, size=format_size(storage.get_slot_size(slot_name)),
+        switch_duration=round(slot_info.average_switch_duration, 2)
+    ))
+    storage.refresh_level_meta([slot_name])
+    level = storage.get_level_meta(slot_name)
+    if level is not None:
+        compatible = RText('✔', RColor.green) if storage.is_slot_compatible(slot_name) else \
+            RText('✘', RColor.red).h(tr('error.incompatible_slot', slot_name))
+        text.append(tr('msg.info_level', level=level, compatible=compatible))
+        game_rules = '\n'.join([f'§7{key}§r: §e{value}§r' for key, value in sorted(level.game_rules.items())])
+        text.append('\n', tr('msg.info_game_rules', len(level.game_rules)).h(game_rules))
+    source.reply(text)
 
 
 def select_option(source: PlayerCommandSource, option_name: str):
@@ -138,12 +233,19 @@ def show_status(source: CommandSource):
     source.reply(tr('msg.status', remain=remaining_time, current=current_slot))
 
 
+def switch_slot(source: CommandSource, slot_name: str):
+    if not storage.is_slot_compatible(slot_name):
+        source.reply(tr('error.incompatible_slot', slot_name))
+        return
+    if switch_queue.submit(SwitchRequest(SwitchPriority.ADMIN, slot_name, src_name(source))):
+        source.reply(tr('msg.switch_queued', slot_name))
+    else:
+        source.reply(tr('msg.switch_coalesced', slot_name))
+
+
 def roller():
-    slot_name, slot_info = storage.random_a_slot(LoadSlotSession.current_slot)
-    if AbstractSession.session_global_lock.locked():
-        gl_server.broadcast(tr('msg.paused'))
-    load_session = LoadSlotSession(slot_name, handle_exc=False)
-    load_session.start()
+    # Slot is picked when the request is dispatched, so it never lands on a map a vote just switched to
+    switch_queue.submit(SwitchRequest(SwitchPriority.AUTO))
 
 
 def settle_vote():
@@ -176,20 +278,37 @@ def debug_stop_rolling(source: CommandSource):
     source.reply('[Debug] Rolling §cstopped§r')
 
 
+def debug_switch_queue(source: CommandSource):
+    source.reply(f'[Debug] Current: {switch_queue.current}')
+    source.reply(f'[Debug] Pending ({switch_queue.depth}): {", ".join([str(item) for item in switch_queue.pending])}')
+
+
+def debug_profile(source: CommandSource, target: str):
+    if session_profiler.arm(target):
+        source.reply(f'[Debug] Profiling armed for the next {target}, report goes to the console')
+    else:
+        source.reply(f'[Debug]§c Profiling of the next {target} is already armed')
+
+
 def debug_randomables(source: CommandSource):
     source.reply(f'[Debug] {", ".join(list(storage.get_random_slots().keys()))}')
 
 
+@new_thread('MapSwitcher_Simulator')
+def debug_simulate(source: CommandSource, rotations: int = 1000, slots: Optional[int] = None,
+                   delay_chance: float = 0.0):
+    slots = max(storage.get_slots_amount(), 2) if slots is None else slots
+    rotation_simulator.run(source, rotations, slots, delay_chance)
+
+
 def register_command():
     # Node requirements
     def permed_literal(literals: Union[str, Iterable[str]]) -> Literal:
         literals = {literals} if isinstance(literals, str) else set(literals)
-        perm = 1
-        for item in literals:
-            target_perm = config.get_prem(item)
-            if target_perm > perm:
-                perm = target_perm
-        return Literal(literals).requires(lambda src: src.has_permission(target_perm))
+        # Looked up on every use so permission changes apply on config reload
+        return Literal(literals).requires(
+            lambda src: src.has_permission(max([1] + [config.get_prem(item) for item in literals]))
+        )
 
     def vote_literal(literals: Union[str, Iterable[str]]):
         return Literal(literals).requires(lambda: VoteSession.get_instance() is None, lambda: tr('error.vote_running_already'))
@@ -212,8 +331,21 @@ def register_command():
         permed_literal('reload').runs(
             lambda src: reload_self(src)
         ),
+        permed_literal('config').then(
+            Literal('reload').runs(lambda src: reload_config(src))
+        ),
         permed_literal('list').runs(
             lambda src: list_worlds(src)
+        ).then(
+            Integer('page').runs(lambda src, ctx: list_worlds(src, ctx['page'])).then(
+                Text('sort').requires(
+                    lambda src, ctx: is_valid_sort(ctx['sort']), lambda: tr('error.invalid_sort', ', '.join(SORT_KEYS))
+                ).runs(lambda src, ctx: list_worlds(src, ctx['page'], ctx['sort'])).then(
+                    QuotableText('keyword').runs(
+                        lambda src, ctx: list_worlds(src, ctx['page'], ctx['sort'], ctx['keyword'])
+                    )
+                )
+            )
         ),
         permed_literal('info').then(
             map_quotable_text('map').runs(lambda src, ctx: info_slot(src, ctx['map']))
@@ -231,6 +363,15 @@ def register_command():
             vote_option_quotable_text('option').runs(lambda src, ctx: select_option(src, ctx['option']))
         ),
         permed_literal('status').runs(lambda src: show_status(src)),
+        permed_literal('switch').then(
+            map_quotable_text('map').runs(lambda src, ctx: switch_slot(src, ctx['map']))
+        ),
+        permed_literal('import').runs(lambda src: import_slots(src)),
+        permed_literal('optimize').then(
+            map_quotable_text('map').runs(lambda src, ctx: optimize_slot(src, ctx['map'])).then(
+                Literal('confirm').runs(lambda src, ctx: optimize_slot(src, ctx['map'], True))
+            )
+        ),
         permed_literal('settle').requires(lambda src: VoteSession.get_instance() is not None).runs(
             lambda: VoteSession.get_instance().settle()
         ).then(
@@ -242,7 +383,22 @@ def register_command():
         permed_literal('session-status').runs(debug_session_status),
         permed_literal('start').runs(lambda src: debug_start_rolling(src)),
         permed_literal('stop').runs(lambda src: debug_stop_rolling(src)),
-        permed_literal('randomables').runs(lambda src: debug_randomables(src))
+        permed_literal('randomables').runs(lambda src: debug_randomables(src)),
+        permed_literal('switch-queue').runs(lambda src: debug_switch_queue(src)),
+        permed_literal('profile').then(
+            Literal('next-switch').runs(lambda src: debug_profile(src, 'switch'))
+        ).then(
+            Literal('next-vote').runs(lambda src: debug_profile(src, 'vote'))
+        ),
+        permed_literal('simulate').runs(lambda src: debug_simulate(src)).then(
+            Integer('rotations').runs(lambda src, ctx: debug_simulate(src, ctx['rotations'])).then(
+                Integer('slots').runs(lambda src, ctx: debug_simulate(src, ctx['rotations'], ctx['slots'])).then(
+                    Float('delay_chance').in_range(0, 1).runs(
+                        lambda src, ctx: debug_simulate(src, ctx['rotations'], ctx['slots'], ctx['delay_chance'])
+                    )
+                )
+            )
+        )
     ]
 
     if DEBUG:
@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Condition, Lock
+from typing import Optional, Callable, Any
+
+from .config import config
+
+
+class CancellationToken:
+    def __init__(self):
+        self.__condition = Condition()
+        self.__cancelled = False
+        self.__notified = False
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self.__cancelled
+
+    def cancel(self):
+        with self.__condition:
+            self.__cancelled = True
+            self.__condition.notify_all()
+
+    def notify(self):
+        with self.__condition:
+            self.__notified = True
+            self.__condition.notify_all()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        # True if woken up by cancel() or notify(), False if timed out
+        with self.__condition:
+            woken = self.__condition.wait_for(lambda: self.__cancelled or self.__notified, timeout)
+            self.__notified = False
+            return woken
+
+
+class SessionExecutor:
+    def __init__(self):
+        self.__pool: Optional[ThreadPoolExecutor] = None
+        self.__lock = Lock()
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> Future:
+        with self.__lock:
+            if self.__pool is None:
+                self.__pool = ThreadPoolExecutor(
+                    max_workers=config.session_workers, thread_name_prefix='MapSwitcher_Session'
+                )
+            return self.__pool.submit(func, *args, **kwargs)
+
+    def refresh(self):
+        # Sessions already running finish on the old pool, new ones get a pool of the current size
+        with self.__lock:
+            if self.__pool is not None:
+                self.__pool.shutdown(wait=False)
+                self.__pool = None
+
+    def shutdown(self):
+        with self.__lock:
+            if self.__pool is not None:
+                self.__pool.shutdown(wait=False, cancel_futures=True)
+                self.__pool = None
+
+
+session_executor = SessionExecutor()
@@ -0,0 +1,213 @@
+import os
+import re
+import shutil
+import tarfile
+import time
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Optional, List, Iterator, Tuple, IO, Callable
+from mcdreforged.api.types import CommandSource
+from mcdreforged.api.rtext import *
+
+from .config import config
+from .storage import storage, SlotInfo
+from .metrics import metrics
+from .utils import gl_server, tr, debug_log, rm, format_size
+
+
+ZIP_SUFFIXES = ('.zip',)
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+IMPORTED_FOLDER = 'imported'
+IMPORTING_SUFFIX = '.importing'
+LEVEL_DAT = 'level.dat'
+
+# (archive member path, opener of the member content)
+ArchiveMember = Tuple[str, Callable[[], IO[bytes]]]
+
+
+def get_archive_suffix(file_name: str) -> Optional[str]:
+    lower_name = file_name.lower()
+    for suffix in sorted(ZIP_SUFFIXES + TAR_SUFFIXES, key=len, reverse=True):
+        if lower_name.endswith(suffix):
+            return suffix
+    return None
+
+
+class ImportResult:
+    def __init__(self, archive: str):
+        self.archive = archive
+        self.slot_name: Optional[str] = None
+        self.size: int = 0
+        self.seconds: float = 0
+        self.error: Optional[Exception] = None
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    @property
+    def throughput(self) -> float:
+        return self.size / self.seconds if self.seconds > 0 else 0
+
+    @property
+    def display_text(self) -> RTextBase:
+        if not self.succeeded:
+            return tr('msg.import.failed', self.archive, RText(str(self.error), RColor.dark_red))
+        return tr(
+            'msg.import.done', archive=self.archive, slot=self.slot_name, size=format_size(self.size),
+            seconds=round(self.seconds, 2), throughput=format_size(round(self.throughput))
+        )
+
+
+class SlotImporter:
+    def __init__(self):
+        self.__running_lock = Lock()
+        self.__name_lock = Lock()
+        self.__reserved_names: List[str] = []
+
+    @staticmethod
+    def get_import_dir():
+        if not os.path.isdir(config.import_folder):
+            os.makedirs(config.import_folder)
+        return config.import_folder
+
+    def list_archives(self) -> List[str]:
+        import_dir = self.get_import_dir()
+        return sorted([
+            item for item in os.listdir(import_dir)
+            if os.path.isfile(os.path.join(import_dir, item)) and get_archive_suffix(item) is not None
+        ])
+
+    @property
+    def is_running(self):
+        return self.__running_lock.locked()
+
+    def reserve_slot_name(self, archive: str) -> str:
+        base_name = archive[:-len(get_archive_suffix(archive))]
+        base_name = re.sub(r'[^\w\-. ]', '_', base_name).strip(' .') or 'imported'
+        with self.__name_lock:
+            slot_name, num = base_name, 1
+            while slot_name in self.__reserved_names or os.path.exists(storage.get_slot_full_dir(slot_name)) or \
+                    os.path.exists(storage.get_slot_full_dir(slot_name + IMPORTING_SUFFIX)):
+                num += 1
+                slot_name = f'{base_name}_{num}'
+            self.__reserved_names.append(slot_name)
+            return slot_name
+
+    def release_slot_name(self, slot_name: str):
+        with self.__name_lock:
+            if slot_name in self.__reserved_names:
+                self.__reserved_names.remove(slot_name)
+
+    @staticmethod
+    def iter_zip_members(archive: zipfile.ZipFile) -> Iterator[ArchiveMember]:
+        for info in archive.infolist():
+            if not info.is_dir():
+                yield info.filename, lambda i=info: archive.open(i)
+
+    @staticmethod
+    def iter_tar_members(archive: tarfile.TarFile) -> Iterator[ArchiveMember]:
+        for info in archive.getmembers():
+            # links and devices are never part of a world save
+            if info.isfile():
+                yield info.name, lambda i=info: archive.extractfile(i)
+
+    @staticmethod
+    def find_world_root(member_names: List[str]) -> str:
+        candidates = []
+        for name in member_names:
+            parts = name.replace('\\', '/').strip('/').split('/')
+            if parts[-1] == LEVEL_DAT:
+                candidates.append(parts[:-1])
+        if len(candidates) == 0:
+            raise FileNotFoundError(f'No {LEVEL_DAT} found in archive')
+        # The shallowest level.dat is the world itself, deeper ones may belong to datapacks or backups inside
+        return '/'.join(min(candidates, key=len))
+
+    @staticmethod
+    def extract_members(members: List[ArchiveMember], world_root: str, target_dir: str) -> int:
+        prefix, size = world_root + '/' if world_root != '' else '', 0
+        real_target = os.path.realpath(target_dir)
+        for name, opener in members:
+            name = name.replace('\\', '/').strip('/')
+            if not name.startswith(prefix):
+                continue
+            relative_path = name[len(prefix):]
+            if relative_path == '' or config.is_file_ignored(os.path.basename(relative_path)):
+                continue
+            target_file = os.path.realpath(os.path.join(real_target, *relative_path.split('/')))
+            if os.path.commonpath([real_target, target_file]) != real_target:
+                raise ValueError(f'Illegal path in archive: {name}')
+            os.makedirs(os.path.dirname(target_file), exist_ok=True)
+            with opener() as src, open(target_file, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            size += os.path.getsize(target_file)
+        return size
+
+    def import_archive(self, archive: str) -> ImportResult:
+        result, start_time = ImportResult(archive), time.time()
+        archive_path = os.path.join(self.get_import_dir(), archive)
+        slot_name = self.reserve_slot_name(archive)
+        temp_dir = storage.get_slot_full_dir(slot_name + IMPORTING_SUFFIX)
+        try:
+            world_dir = os.path.join(temp_dir, config.world_names[0])
+            if get_archive_suffix(archive) in ZIP_SUFFIXES:
+                with zipfile.ZipFile(archive_path) as zip_archive:
+                    members = list(self.iter_zip_members(zip_archive))
+                    world_root = self.find_world_root([item[0] for item in members])
+                    result.size = self.extract_members(members, world_root, world_dir)
+            else:
+                with tarfile.open(archive_path, 'r:*') as tar_archive:
+                    members = list(self.iter_tar_members(tar_archive))
+                    world_root = self.find_world_root([item[0] for item in members])
+                    result.size = self.extract_members(members, world_root, world_dir)
+            debug_log(f'Extracted world root "{world_root}" of {archive} to {temp_dir}')
+
+            # Only a completely extracted slot gets its final name and becomes visible in the catalog
+            os.rename(temp_dir, storage.get_slot_full_dir(slot_name))
+            SlotInfo(comment=f'Imported from {archive}').save(slot_name)
+
+            imported_dir = os.path.join(self.get_import_dir(), IMPORTED_FOLDER)
+            os.makedirs(imported_dir, exist_ok=True)
+            shutil.move(archive_path, os.path.join(imported_dir, archive))
+            result.slot_name = slot_name
+            metrics.imports.inc(result='success')
+            metrics.import_bytes.inc(result.size)
+        except Exception as exc:
+            gl_server.logger.exception(f'Failed to import map archive {archive}')
+            rm(temp_dir)
+            result.error = exc
+            metrics.imports.inc(result='failed')
+        finally:
+            self.release_slot_name(slot_name)
+        result.seconds = time.time() - start_time
+        return result
+
+    def run(self, source: CommandSource):
+        if not self.__running_lock.acquire(blocking=False):
+            source.reply(tr('error.import_running'))
+            return
+        try:
+            archives = self.list_archives()
+            if len(archives) == 0:
+                source.reply(tr('msg.import.empty', self.get_import_dir()))
+                return
+            source.reply(tr('msg.import.start', len(archives), config.import_workers))
+            start_time, results = time.time(), []
+            with ThreadPoolExecutor(max_workers=config.import_workers, thread_name_prefix='MapSwitcher_Import') as pool:
+                for result in pool.map(self.import_archive, archives):
+                    results.append(result)
+                    source.reply(result.display_text)
+            succeeded = [item for item in results if item.succeeded]
+            storage.refresh_level_meta([item.slot_name for item in succeeded])
+            source.reply(tr(
+                'msg.import.summary', success=len(succeeded), total=len(results),
+                size=format_size(sum([item.size for item in succeeded])), seconds=round(time.time() - start_time, 2)
+            ))
+        finally:
+            self.__running_lock.release()
+
+
+importer = SlotImporter()
@@ -0,0 +1,138 @@
+import json
+import os
+import zipfile
+import zlib
+
+from typing import Optional, List, Dict, Any
+from mcdreforged.api.utils import Serializable
+
+from .config import config
+from .nbt import load_nbt_file, NbtError
+from .utils import debug_log
+
+
+LEVEL_DAT = 'level.dat'
+
+
+class LevelMeta(Serializable):
+    level_name: str = ''
+    version_name: Optional[str] = None
+    data_version: Optional[int] = None
+    spawn: Optional[List[int]] = None
+    game_rules: Dict[str, str] = {}
+    mtime: float = 0  # of the level.dat parsed, the cached copy is dropped once it changes
+
+    @property
+    def spawn_formatted(self) -> str:
+        return 'N/A' if self.spawn is None else ', '.join([str(item) for item in self.spawn])
+
+    @staticmethod
+    def __read_spawn(data: Dict[str, Any]) -> Optional[List[int]]:
+        if 'SpawnX' in data:
+            return [data.get('SpawnX', 0), data.get('SpawnY', 0), data.get('SpawnZ', 0)]
+        # Moved into a "spawn" compound with an int array since 1.21.9
+        spawn = data.get('spawn')
+        if isinstance(spawn, dict) and len(spawn.get('pos', ())) == 3:
+            return list(spawn['pos'])
+        return None
+
+    @classmethod
+    def read(cls, level_dat: str) -> 'LevelMeta':
+        data = load_nbt_file(level_dat).get('Data', {})
+        version = data.get('Version', {})
+        game_rules = data.get('GameRules', data.get('game_rules', {}))
+        return cls(
+            level_name=str(data.get('LevelName', '')),
+            version_name=version.get('Name') if isinstance(version, dict) else None,
+            data_version=data.get('DataVersion'),
+            spawn=cls.__read_spawn(data),
+            game_rules={str(key): str(value) for key, value in game_rules.items()} if isinstance(game_rules, dict) else {},
+            mtime=os.path.getmtime(level_dat)
+        )
+
+
+def find_level_dat(folder: str) -> Optional[str]:
+    # Slots keep the world folder named after world_names[0], some archives hold a bare world instead
+    for path in (os.path.join(folder, config.world_names[0], LEVEL_DAT), os.path.join(folder, LEVEL_DAT)):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def load_level_meta(folder: str, cached: Optional[LevelMeta] = None) -> Optional[LevelMeta]:
+    level_dat = find_level_dat(folder)
+    if level_dat is None:
+        return None
+    if cached is not None and cached.mtime == os.path.getmtime(level_dat):
+        return cached
+    try:
+        return LevelMeta.read(level_dat)
+    except (OSError, EOFError, zlib.error, NbtError) as exc:
+        debug_log(f'Failed to parse {level_dat}: {exc}')
+        return None
+
+
+class DataVersionChecker:
+    def __init__(self):
+        self.__detected: Optional[int] = None
+
+    @property
+    def server_data_version(self) -> Optional[int]:
+        if config.data_version.server_data_version is not None:
+            return config.data_version.server_data_version
+        if self.__detected is None:
+            self.__detected = self.detect()
+        return self.__detected
+
+    @staticmethod
+    def detect_from_jar() -> Optional[int]:
+        # Vanilla jars, and the bundler of 1.18+, carry the DataVersion as world_version of version.json
+        versions = set()
+        for file_name in os.listdir(config.server_path):
+            if not file_name.endswith('.jar'):
+                continue
+            try:
+                with zipfile.ZipFile(os.path.join(config.server_path, file_name)) as jar:
+                    if 'version.json' in jar.namelist():
+                        versions.add(json.loads(jar.read('version.json')).get('world_version'))
+            except (OSError, zipfile.BadZipFile, ValueError, AttributeError) as exc:
+                debug_log(f'Failed to read version.json from {file_name}: {exc}')
+        versions.discard(None)
+        # Several server jars of different versions, there is no telling which one is started
+        return versions.pop() if len(versions) == 1 else None
+
+    @classmethod
+    def detect(cls) -> Optional[int]:
+        from .world_cache import ServerProperties
+
+        data_version = cls.detect_from_jar()
+        if data_version is not None:
+            debug_log(f'Detected server DataVersion {data_version} from server jar')
+            return data_version
+
+        # The live world is rewritten by the server on every save, so it carries the server's DataVersion
+        level_name = ServerProperties(config.server_path).level_name
+        meta = load_level_meta(os.path.join(config.server_path, level_name))
+        if meta is None or meta.data_version is None:
+            return None
+        debug_log(f'Detected server DataVersion {meta.data_version} from world {level_name}')
+        return meta.data_version
+
+    def forget(self):
+        self.__detected = None
+
+    def refresh(self):
+        # Called while the server is stopped, the jar may have been replaced and the live world was just saved
+        self.__detected = self.detect()
+
+    def is_compatible(self, meta: Optional[LevelMeta]) -> bool:
+        # Slots and servers of unknown version are let through, the check is only a shortcut
+        if not config.data_version.check or meta is None or meta.data_version is None:
+            return True
+        server_version = self.server_data_version
+        if server_version is None or meta.data_version == server_version:
+            return True
+        return config.data_version.allow_older and meta.data_version < server_version
+
+
+data_version_checker = DataVersionChecker()
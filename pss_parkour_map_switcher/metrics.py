@@ -0,0 +1,278 @@
+import math
+import os
+import time
+
+from threading import RLock, Event
+from typing import Dict, List, Tuple, Callable, Optional, Iterable
+from mcdreforged.api.decorator import new_thread
+
+from .config import config
+from .utils import gl_server, debug_log
+
+
+LabelValues = Tuple[str, ...]
+METRIC_PREFIX = 'pss_parkour_map_switcher'
+DEFAULT_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value))
+
+
+def format_labels(label_names: Iterable[str], label_values: Iterable[str]) -> str:
+    pairs = []
+    for name, value in zip(label_names, label_values):
+        value = str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}' if len(pairs) > 0 else ''
+
+
+class Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()):
+        self.name = f'{METRIC_PREFIX}_{name}'
+        self.documentation = documentation
+        self.label_names: LabelValues = tuple(label_names)
+        self._lock = RLock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError(f'Metric {self.name} requires labels {self.label_names}, got {tuple(labels.keys())}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> List[Tuple[str, LabelValues, float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        for suffix_name, label_values, value in self.samples():
+            label_names = self.label_names + (('le',) if len(label_values) > len(self.label_names) else ())
+            lines.append(f'{suffix_name}{format_labels(label_names, label_values)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()):
+        super(Counter, self).__init__(name, documentation, label_names)
+        self.__values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        if amount < 0:
+            raise ValueError('Counter can only increase')
+        key = self._label_values(labels)
+        with self._lock:
+            self.__values[key] = self.__values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self.__values.items()]
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()):
+        super(Gauge, self).__init__(name, documentation, label_names)
+        self.__values: Dict[LabelValues, float] = {}
+        self.__function: Optional[Callable[[], Optional[float]]] = None
+
+    def set(self, value: float, **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            self.__values[key] = value
+
+    def set_function(self, func: Optional[Callable[[], Optional[float]]]):
+        if len(self.label_names) != 0:
+            raise ValueError('Callback gauge can not have labels')
+        self.__function = func
+
+    def samples(self):
+        if self.__function is not None:
+            try:
+                value = self.__function()
+            except Exception as exc:
+                debug_log(f'Failed to collect gauge {self.name}: {exc}')
+                return []
+            return [] if value is None else [(self.name, (), value)]
+        with self._lock:
+            return [(self.name, key, value) for key, value in self.__values.items()]
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets)) + (math.inf,)
+        self.__counts: Dict[LabelValues, List[int]] = {}
+        self.__sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            counts = self.__counts.setdefault(key, [0] * len(self.buckets))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.__sums[key] = self.__sums.get(key, 0) + value
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, counts in self.__counts.items():
+                for bound, count in zip(self.buckets, counts):
+                    result.append((f'{self.name}_bucket', key + (format_value(bound),), count))
+                result.append((f'{self.name}_count', key, counts[-1]))
+                result.append((f'{self.name}_sum', key, self.__sums[key]))
+        return result
+
+
+class PluginMetrics:
+    def __init__(self):
+        self.__metrics: List[Metric] = []
+        self.switches = self.register(Counter(
+            'switches_total', 'Map switches handled by LoadSlotSession', ('result',)
+        ))
+        self.switch_duration = self.register(Histogram(
+            'switch_duration_seconds', 'Time from switch start to server start, countdown included'
+        ))
+        self.switch_copy_duration = self.register(Histogram(
+            'switch_copy_duration_seconds', 'Time spent on backing up, removing and copying world files'
+        ))
+        self.world_cache_lookups = self.register(Counter(
+            'world_cache_lookups_total', 'Switches served by the materialized world cache', ('result',)
+        ))
+        self.world_cache_evictions = self.register(Counter(
+            'world_cache_evictions_total', 'Materialized worlds evicted from the world cache'
+        ))
+        self.switch_requests = self.register(Counter(
+            'switch_requests_total', 'Requests handled by the switch queue', ('priority', 'result')
+        ))
+        self.switch_queue_depth = self.register(Gauge(
+            'switch_queue_depth', 'Switch requests waiting in the switch queue'
+        ))
+        self.switch_queue_wait = self.register(Histogram(
+            'switch_queue_wait_seconds', 'Time a switch request waited in the queue before being dispatched',
+            buckets=(0.01, 0.1, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0)
+        ))
+        self.rollbacks = self.register(Counter(
+            'rollbacks_total', 'World rollbacks performed by LoadSlotSession.on_error'
+        ))
+        self.votes = self.register(Counter(
+            'votes_total', 'Vote sessions by their outcome', ('result',)
+        ))
+        self.vote_participants = self.register(Histogram(
+            'vote_participants', 'Players who voted when a vote round is settled',
+            buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34)
+        ))
+        self.vote_participation = self.register(Gauge(
+            'vote_participation_ratio', 'Voters divided by online players of the latest settled vote round'
+        ))
+        self.online_players = self.register(Gauge(
+            'online_players', 'Players online on the server'
+        ))
+        self.vote_overtimes = self.register(Counter(
+            'vote_overtimes_total', 'Overtime rounds started by draws'
+        ))
+        self.catalog_scans = self.register(Counter(
+            'catalog_scans_total', 'Rescans of slot folders in backup path'
+        ))
+        self.catalog_scan_duration = self.register(Histogram(
+            'catalog_scan_duration_seconds', 'Time spent on one rescan of slot folders',
+            buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+        ))
+        self.catalog_slots = self.register(Gauge(
+            'catalog_slots', 'Slots in the catalog after the latest rescan'
+        ))
+        self.imports = self.register(Counter(
+            'imports_total', 'Map archives imported from the drop folder', ('result',)
+        ))
+        self.import_bytes = self.register(Counter(
+            'import_bytes_total', 'Bytes extracted from imported map archives'
+        ))
+        self.rolling_delays = self.register(Counter(
+            'rolling_delays_total', 'Delays applied to auto rolling by votes'
+        ))
+        self.rolling_delay_minutes = self.register(Counter(
+            'rolling_delay_minutes_total', 'Minutes added to auto rolling by votes'
+        ))
+        self.rolling_lateness = self.register(Histogram(
+            'rolling_lateness_seconds', 'Difference between planned and actual auto rolling trigger time',
+            buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+        ))
+        self.rolling_remaining = self.register(Gauge(
+            'rolling_remaining_seconds', 'Remaining time until next auto rolling'
+        ))
+        self.last_write = self.register(Gauge(
+            'last_write_timestamp_seconds', 'Unix time the metrics file was written'
+        ))
+
+    def register(self, metric: Metric):
+        self.__metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        self.last_write.set(time.time())
+        lines = []
+        for metric in self.__metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file_path: str):
+        folder = os.path.dirname(os.path.abspath(file_path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # node_exporter only collects *.prom, so the temp file is never read half-written
+        temp_file = f'{file_path}.{os.getpid()}.tmp'
+        with open(temp_file, 'w', encoding='UTF-8') as f:
+            f.write(self.render())
+        os.replace(temp_file, file_path)
+
+
+class MetricsExporter:
+    def __init__(self, plugin_metrics: PluginMetrics):
+        self.__metrics = plugin_metrics
+        self.__stop_event = Event()
+        self.__running = False
+
+    @property
+    def is_running(self):
+        return self.__running
+
+    def start(self):
+        if not config.metrics.enabled or self.__running:
+            return
+        self.__stop_event.clear()
+        self.__running = True
+        self.__loop()
+
+    @new_thread('MapSwitcher_MetricsExporter')
+    def __loop(self):
+        debug_log(f'Metrics exporter started, writing to {config.metrics.textfile_path}')
+        while True:
+            self.write_once()
+            if self.__stop_event.wait(config.metrics.write_interval):
+                break
+        self.write_once()
+        self.__running = False
+
+    def write_once(self):
+        try:
+            self.__metrics.write(config.metrics.textfile_path)
+        except Exception:
+            gl_server.logger.exception('Failed to write metrics file')
+
+    def stop(self):
+        self.__stop_event.set()
+
+
+metrics = PluginMetrics()
+exporter = MetricsExporter(metrics)
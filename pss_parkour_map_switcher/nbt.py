@@ -0,0 +1,122 @@
+import gzip
+import struct
+import zlib
+
+from typing import Any, Dict, Tuple, Callable, List
+
+
+TAG_END = 0
+TAG_BYTE = 1
+TAG_SHORT = 2
+TAG_INT = 3
+TAG_LONG = 4
+TAG_FLOAT = 5
+TAG_DOUBLE = 6
+TAG_BYTE_ARRAY = 7
+TAG_STRING = 8
+TAG_LIST = 9
+TAG_COMPOUND = 10
+TAG_INT_ARRAY = 11
+TAG_LONG_ARRAY = 12
+
+
+class NbtError(ValueError):
+    pass
+
+
+class NbtReader:
+    # Read-only, big-endian (Java Edition) NBT
+    __scalars = {
+        TAG_BYTE: struct.Struct('>b'),
+        TAG_SHORT: struct.Struct('>h'),
+        TAG_INT: struct.Struct('>i'),
+        TAG_LONG: struct.Struct('>q'),
+        TAG_FLOAT: struct.Struct('>f'),
+        TAG_DOUBLE: struct.Struct('>d'),
+    }
+    __array_types = {
+        TAG_BYTE_ARRAY: 'b',
+        TAG_INT_ARRAY: 'i',
+        TAG_LONG_ARRAY: 'q',
+    }
+
+    def __init__(self, data: bytes):
+        self.__data = data
+        self.__pos = 0
+        self.__readers: Dict[int, Callable[[], Any]] = {
+            TAG_STRING: self.__read_string,
+            TAG_LIST: self.__read_list,
+            TAG_COMPOUND: self.__read_compound,
+        }
+
+    def __take(self, length: int) -> bytes:
+        # A negative length would move backwards and surface as a struct.error instead
+        if length < 0:
+            raise NbtError(f'Negative NBT length {length}')
+        if self.__pos + length > len(self.__data):
+            raise NbtError('Unexpected end of NBT data')
+        chunk = self.__data[self.__pos:self.__pos + length]
+        self.__pos += length
+        return chunk
+
+    def __unpack(self, fmt: struct.Struct) -> Any:
+        return fmt.unpack(self.__take(fmt.size))[0]
+
+    def __read_string(self) -> str:
+        length = self.__unpack(self.__scalars[TAG_SHORT]) & 0xFFFF
+        return self.__take(length).decode('utf-8', errors='replace')
+
+    def __read_list(self) -> List[Any]:
+        tag_type = self.__unpack(self.__scalars[TAG_BYTE])
+        length = self.__unpack(self.__scalars[TAG_INT])
+        if tag_type == TAG_END or length <= 0:
+            return []
+        return [self.read_payload(tag_type) for _ in range(length)]
+
+    def __read_compound(self) -> Dict[str, Any]:
+        result = {}
+        while True:
+            tag_type = self.__unpack(self.__scalars[TAG_BYTE])
+            if tag_type == TAG_END:
+                return result
+            name = self.__read_string()
+            result[name] = self.read_payload(tag_type)
+
+    def read_payload(self, tag_type: int) -> Any:
+        if tag_type in self.__scalars:
+            return self.__unpack(self.__scalars[tag_type])
+        if tag_type in self.__array_types:
+            length = self.__unpack(self.__scalars[TAG_INT])
+            if length < 0:
+                raise NbtError(f'Negative NBT array length {length}')
+            item_type = self.__array_types[tag_type]
+            return struct.unpack(f'>{length}{item_type}', self.__take(length * struct.calcsize(item_type)))
+        reader = self.__readers.get(tag_type)
+        if reader is None:
+            raise NbtError(f'Unknown NBT tag type {tag_type}')
+        return reader()
+
+    def read_root(self) -> Tuple[str, Dict[str, Any]]:
+        tag_type = self.__unpack(self.__scalars[TAG_BYTE])
+        if tag_type != TAG_COMPOUND:
+            raise NbtError(f'Root tag must be a compound, got {tag_type}')
+        name = self.__read_string()
+        return name, self.__read_compound()
+
+
+def load_nbt(data: bytes) -> Dict[str, Any]:
+    return NbtReader(data).read_root()[1]
+
+
+def load_compressed_nbt(data: bytes) -> Dict[str, Any]:
+    # gzip for level.dat and player data, zlib for most chunks
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    elif len(data) > 0 and data[0] == 0x78:
+        data = zlib.decompress(data)
+    return load_nbt(data)
+
+
+def load_nbt_file(file_path: str) -> Dict[str, Any]:
+    with open(file_path, 'rb') as f:
+        return load_compressed_nbt(f.read())
@@ -0,0 +1,143 @@
+import re
+import time
+
+from threading import RLock, Lock
+from typing import Set, Dict, Callable, Any, List, Optional
+from mcdreforged.api.decorator import new_thread
+from mcdreforged.api.types import Info
+
+from .config import config
+from .utils import gl_server, debug_log
+
+
+# Names follow on the next line before 1.13, such a response is only trusted when nobody is online
+LIST_PATTERN = re.compile(r'There are (\d+)(?: of a max of |/)(\d+) players online:(.*)$')
+
+
+class PlayerTracker:
+    def __init__(self):
+        self.__players: Set[str] = set()
+        self.__lock = RLock()
+        self.__maintenance_lock = Lock()
+        # Player list is unknown until the server starts, or a former plugin instance hands it over
+        self.__synced = False
+        self.__awaiting_list = False
+        self.__idle_listeners: List[Callable[[], Any]] = []
+        self.__idle_tasks: Dict[str, Callable[[], Any]] = {}
+
+    @property
+    def players(self) -> List[str]:
+        with self.__lock:
+            return sorted(self.__players)
+
+    @property
+    def online_amount(self) -> int:
+        with self.__lock:
+            return len(self.__players)
+
+    @property
+    def is_synced(self) -> bool:
+        return self.__synced
+
+    @property
+    def is_idle(self) -> bool:
+        with self.__lock:
+            return self.__synced and len(self.__players) == 0 and gl_server.is_server_running()
+
+    def sync(self, players: Optional[List[str]] = None):
+        with self.__lock:
+            self.__players = set() if players is None else set(players)
+            self.__synced = True
+        debug_log(f'Player list synced: {self.players}')
+
+    def inherit(self, former: Optional['PlayerTracker']):
+        if former is not None and former.is_synced:
+            self.sync(former.players)
+        elif not gl_server.is_server_running():
+            self.sync()
+
+    @new_thread('MapSwitcher_PlayerSync')
+    def request_sync(self):
+        # Loaded into a running server with nothing to inherit, ask the server who is online
+        if self.__synced or not gl_server.is_server_running():
+            return
+        if gl_server.is_rcon_running():
+            result = gl_server.rcon_query('list')
+            if result is not None and self.parse_list(result):
+                return
+        self.__awaiting_list = True
+        gl_server.execute('list')
+
+    def parse_list(self, content: str) -> bool:
+        match = LIST_PATTERN.search(content)
+        if match is None:
+            return False
+        players = [item.strip() for item in match.group(3).split(',') if item.strip() != '']
+        if len(players) != int(match.group(1)):
+            return False
+        self.sync(players)
+        if self.is_idle:
+            self.run_idle_tasks()
+        return True
+
+    def on_info(self, info: Info):
+        if self.__awaiting_list and info.is_from_server and self.parse_list(info.content):
+            self.__awaiting_list = False
+
+    def on_join(self, player: str):
+        with self.__lock:
+            self.__players.add(player)
+
+    def on_leave(self, player: str):
+        with self.__lock:
+            if player not in self.__players and not self.__synced:
+                return
+            self.__players.discard(player)
+            became_idle = len(self.__players) == 0 and self.__synced
+        if became_idle:
+            self.on_idle()
+
+    def on_server_startup(self):
+        self.sync()
+        self.run_idle_tasks()
+
+    def on_server_stop(self):
+        with self.__lock:
+            self.__players.clear()
+
+    def add_idle_listener(self, listener: Callable[[], Any]):
+        self.__idle_listeners.append(listener)
+
+    def register_idle_task(self, name: str, task: Callable[[], Any]):
+        self.__idle_tasks[name] = task
+
+    def on_idle(self):
+        debug_log('Server is idle now')
+        for listener in self.__idle_listeners:
+            try:
+                listener()
+            except Exception:
+                gl_server.logger.exception('Error occurred in idle listener of MapSwitcher')
+        self.run_idle_tasks()
+
+    @new_thread('MapSwitcher_IdleMaintenance')
+    def run_idle_tasks(self):
+        if not config.idle_maintenance or not self.__maintenance_lock.acquire(blocking=False):
+            return
+        try:
+            for name, task in self.__idle_tasks.items():
+                # Stop as soon as someone joins, remaining tasks will run on next idle
+                if not self.is_idle:
+                    debug_log(f'Idle maintenance paused before "{name}"')
+                    break
+                start_time = time.time()
+                try:
+                    task()
+                except Exception:
+                    gl_server.logger.exception(f'Error occurred in idle maintenance task "{name}"')
+                debug_log(f'Idle maintenance task "{name}" took {round(time.time() - start_time, 2)} s')
+        finally:
+            self.__maintenance_lock.release()
+
+
+player_tracker = PlayerTracker()
@@ -0,0 +1,92 @@
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+
+from threading import Lock
+from typing import Callable, Any, Set
+
+from .utils import gl_server
+
+
+PROFILE_FOLDER = 'profiles'
+PROFILE_TARGETS = ('switch', 'vote')
+TOP_ALLOCATIONS = 25
+SUMMARY_FUNCTIONS = 8
+
+
+class SessionProfiler:
+    def __init__(self):
+        self.__lock = Lock()
+        self.__armed: Set[str] = set()
+
+    def arm(self, target: str) -> bool:
+        if target not in PROFILE_TARGETS:
+            raise ValueError(f'Unknown profile target {target}')
+        with self.__lock:
+            if target in self.__armed:
+                return False
+            self.__armed.add(target)
+            return True
+
+    def __take(self, target: str) -> bool:
+        with self.__lock:
+            if target not in self.__armed:
+                return False
+            self.__armed.discard(target)
+            return True
+
+    def run(self, target: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        # Runs func as is unless a capture of target is armed, only the first call after arming is captured
+        if not self.__take(target):
+            return func(*args, **kwargs)
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        profile, start_time = cProfile.Profile(), time.perf_counter()
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            wall_time = time.perf_counter() - start_time
+            snapshot, peak = tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()[1]
+            if started_tracing:
+                tracemalloc.stop()
+            try:
+                self.__report(target, profile, snapshot, peak, wall_time)
+            except Exception:
+                gl_server.logger.exception(f'Failed to write profile of {target}')
+
+    @staticmethod
+    def __report(target: str, profile: cProfile.Profile, snapshot: tracemalloc.Snapshot, peak: int,
+                 wall_time: float):
+        folder = os.path.join(gl_server.get_data_folder(), PROFILE_FOLDER)
+        os.makedirs(folder, exist_ok=True)
+        base_name = os.path.join(folder, f'{target}_{time.strftime("%Y%m%d_%H%M%S")}')
+        profile.dump_stats(f'{base_name}.pstats')
+
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        top_allocations = snapshot.statistics('lineno')[:TOP_ALLOCATIONS]
+        with open(f'{base_name}_allocations.txt', 'w', encoding='UTF-8') as f:
+            f.write(f'Top {TOP_ALLOCATIONS} allocations still alive after {target}, peak {peak} bytes\n')
+            for stat in top_allocations:
+                f.write(f'{stat}\n')
+
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(SUMMARY_FUNCTIONS)
+        logger = gl_server.logger
+        logger.info(f'[Profile] {target} took {round(wall_time, 3)} s, peak traced memory {round(peak / 2 ** 20, 2)} MiB')
+        for line in summary.getvalue().splitlines():
+            if line.strip() != '':
+                logger.info(f'[Profile] {line}')
+        logger.info(f'[Profile] Written to {base_name}.pstats and {base_name}_allocations.txt')
+
+
+session_profiler = SessionProfiler()
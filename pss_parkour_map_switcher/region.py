@@ -0,0 +1,379 @@
+import gzip
+import os
+import re
+import shutil
+import struct
+import zlib
+
+from threading import Lock
+from typing import Dict, Tuple, Optional, List, Set
+from mcdreforged.api.types import CommandSource
+from mcdreforged.api.rtext import RAction
+
+from .config import config
+from .level import LEVEL_DAT
+from .nbt import load_nbt, load_nbt_file, NbtError
+from .storage import storage, SLOT_INFO_FILE
+from .utils import gl_server, tr, debug_log, format_size, rm
+
+
+SECTOR_SIZE = 4096
+CHUNKS_PER_REGION = 1024
+REGION_FILE_PATTERN = re.compile(r'^r\.(-?\d+)\.(-?\d+)\.mca$')
+TERRAIN_FOLDER = 'region'
+ENTITIES_FOLDER = 'entities'
+# Folders holding per-chunk data which follows the decision made on terrain regions
+FOLLOWER_FOLDERS = (ENTITIES_FOLDER, 'poi')
+EXTERNAL_CHUNK_FLAG = 0x80
+AIR_BLOCKS = ('minecraft:air', 'minecraft:cave_air', 'minecraft:void_air')
+# Generators leaving removed chunks empty, any other one fills them with natural terrain again
+EMPTY_GENERATORS = ('flat', 'void')
+DIMENSION_FOLDERS = {'.': 'minecraft:overworld', 'DIM-1': 'minecraft:the_nether', 'DIM1': 'minecraft:the_end'}
+OPTIMIZING_SUFFIX = '.optimizing'
+REPLACED_SUFFIX = '.pre_optimize'
+ChunkPos = Tuple[int, int]
+
+
+class ChunkEntry:
+    __slots__ = ('index', 'timestamp', 'raw')
+
+    def __init__(self, index: int, timestamp: int, raw: bytes):
+        self.index = index
+        self.timestamp = timestamp
+        # 4 bytes length, 1 byte compression type and the payload, written back untouched
+        self.raw = raw
+
+    @property
+    def compression(self) -> int:
+        return self.raw[4]
+
+    def load(self) -> Optional[dict]:
+        compression, payload = self.compression, self.raw[5:]
+        if compression & EXTERNAL_CHUNK_FLAG:
+            return None
+        if compression == 1:
+            payload = gzip.decompress(payload)
+        elif compression == 2:
+            payload = zlib.decompress(payload)
+        elif compression != 3:
+            # LZ4 or custom compression, can't be inspected here
+            return None
+        return load_nbt(payload)
+
+
+class RegionFile:
+    def __init__(self, path: str):
+        self.path = path
+        match = REGION_FILE_PATTERN.match(os.path.basename(path))
+        if match is None:
+            raise ValueError(f'Not a region file: {path}')
+        self.region_x, self.region_z = int(match.group(1)), int(match.group(2))
+        self.chunks: Dict[int, ChunkEntry] = {}
+
+    def chunk_pos(self, index: int) -> ChunkPos:
+        return self.region_x * 32 + index % 32, self.region_z * 32 + index // 32
+
+    def remove_chunk(self, index: int):
+        chunk = self.chunks.pop(index)
+        # Oversized chunks live in their own c.<x>.<z>.mcc file next to the region
+        if chunk.compression & EXTERNAL_CHUNK_FLAG:
+            x, z = self.chunk_pos(index)
+            external_file = os.path.join(os.path.dirname(self.path), f'c.{x}.{z}.mcc')
+            if os.path.isfile(external_file):
+                os.remove(external_file)
+
+    def read(self) -> 'RegionFile':
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if len(data) < SECTOR_SIZE * 2:
+            return self
+        locations = struct.unpack_from(f'>{CHUNKS_PER_REGION}I', data, 0)
+        timestamps = struct.unpack_from(f'>{CHUNKS_PER_REGION}I', data, SECTOR_SIZE)
+        for index, location in enumerate(locations):
+            offset, sectors = (location >> 8) * SECTOR_SIZE, location & 0xFF
+            if offset == 0 or sectors == 0 or offset + 5 > len(data):
+                continue
+            length = struct.unpack_from('>I', data, offset)[0]
+            if length == 0 or offset + 4 + length > len(data):
+                continue
+            self.chunks[index] = ChunkEntry(index, timestamps[index], data[offset:offset + 4 + length])
+        return self
+
+    def write(self, path: Optional[str] = None):
+        path = self.path if path is None else path
+        locations, timestamps, body = [0] * CHUNKS_PER_REGION, [0] * CHUNKS_PER_REGION, []
+        sector = 2
+        for index in sorted(self.chunks.keys()):
+            chunk = self.chunks[index]
+            sectors = (len(chunk.raw) + SECTOR_SIZE - 1) // SECTOR_SIZE
+            locations[index] = (sector << 8) | sectors
+            timestamps[index] = chunk.timestamp
+            body.append(chunk.raw + b'\x00' * (sectors * SECTOR_SIZE - len(chunk.raw)))
+            sector += sectors
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(struct.pack(f'>{CHUNKS_PER_REGION}I', *locations))
+            f.write(struct.pack(f'>{CHUNKS_PER_REGION}I', *timestamps))
+            for item in body:
+                f.write(item)
+        os.replace(temp_path, path)
+
+
+class OptimizeReport:
+    def __init__(self, slot_name: str, dry_run: bool = False):
+        self.slot_name = slot_name
+        self.dry_run = dry_run
+        self.size_before = 0
+        self.size_after = 0
+        self.chunks_removed = 0
+        self.chunks_kept = 0
+        self.regions_removed = 0
+
+    @property
+    def saved(self) -> int:
+        return self.size_before - self.size_after
+
+
+class RegionOptimizer:
+    def __init__(self):
+        self.__lock = Lock()
+
+    @staticmethod
+    def get_chunk_box() -> Optional[Tuple[int, int, int, int]]:
+        box = config.optimize.bounding_box
+        if box is None or len(box) != 4:
+            return None
+        x1, z1, x2, z2 = box
+        return min(x1, x2) >> 4, min(z1, z2) >> 4, max(x1, x2) >> 4, max(z1, z2) >> 4
+
+    @staticmethod
+    def is_region_outside(region: RegionFile, chunk_box: Optional[Tuple[int, int, int, int]]) -> bool:
+        if chunk_box is None:
+            return False
+        min_x, min_z, max_x, max_z = chunk_box
+        x, z = region.region_x * 32, region.region_z * 32
+        return x + 31 < min_x or x > max_x or z + 31 < min_z or z > max_z
+
+    @staticmethod
+    def is_chunk_empty(level: dict) -> bool:
+        # Only chunks proven to hold nothing count as empty, unknown layouts are kept
+        if len(level.get('block_entities', level.get('TileEntities', []))) > 0 or len(level.get('Entities', [])) > 0:
+            return False
+        sections = level.get('sections', level.get('Sections'))
+        if sections is None:
+            return False
+        for section in sections:
+            if 'block_states' in section:
+                palette = section['block_states'].get('palette', [])
+            elif 'Palette' in section:
+                palette = section['Palette']
+            elif 'Blocks' in section:
+                # Numeric block ids before 1.13, not inspected
+                return False
+            else:
+                continue
+            for block in palette:
+                if block.get('Name') not in AIR_BLOCKS:
+                    return False
+        return True
+
+    @staticmethod
+    def get_dimension_generator(dimension: str, slot_dir: str) -> Optional[str]:
+        # Read from level.dat of the world holding the dimension, None if unknown
+        world_dir = dimension
+        while not os.path.isfile(os.path.join(world_dir, LEVEL_DAT)):
+            if os.path.normpath(world_dir) == os.path.normpath(slot_dir):
+                return None
+            world_dir = os.path.dirname(world_dir)
+        relative = os.path.relpath(dimension, world_dir).replace(os.sep, '/')
+        parts = relative.split('/')
+        if relative in DIMENSION_FOLDERS:
+            dimension_id = DIMENSION_FOLDERS[relative]
+        elif len(parts) >= 3 and parts[0] == 'dimensions':
+            dimension_id = f'{parts[1]}:{"/".join(parts[2:])}'
+        else:
+            return None
+        try:
+            data = load_nbt_file(os.path.join(world_dir, LEVEL_DAT)).get('Data', {})
+        except (OSError, EOFError, zlib.error, NbtError) as exc:
+            debug_log(f'Failed to read generator of {dimension}: {exc}')
+            return None
+        settings = data.get('WorldGenSettings')
+        if isinstance(settings, dict):
+            generator = settings.get('dimensions', {}).get(dimension_id, {})
+            generator = generator.get('generator', {}) if isinstance(generator, dict) else {}
+            generator_type = generator.get('type') if isinstance(generator, dict) else None
+            return None if generator_type is None else str(generator_type).replace('minecraft:', '')
+        # Only the overworld is configurable before 1.16
+        if dimension_id == 'minecraft:overworld' and 'generatorName' in data:
+            return str(data['generatorName']).lower()
+        return None
+
+    @staticmethod
+    def find_entity_chunks(folder: str) -> Set[ChunkPos]:
+        # Entities are stored apart from terrain since 1.17, air chunks may still hold armor stands or markers
+        result = set()
+        if not os.path.isdir(folder):
+            return result
+        for file_name in os.listdir(folder):
+            if REGION_FILE_PATTERN.match(file_name) is None:
+                continue
+            region = RegionFile(os.path.join(folder, file_name)).read()
+            for index, chunk in region.chunks.items():
+                try:
+                    data = chunk.load()
+                except (OSError, zlib.error, NbtError):
+                    data = None
+                # Unreadable ones are counted in, they are kept rather than guessed
+                if data is None or len(data.get('Entities', [])) > 0:
+                    result.add(region.chunk_pos(index))
+        return result
+
+    def should_keep_chunk(self, chunk: ChunkEntry, pos: ChunkPos, chunk_box: Optional[Tuple[int, int, int, int]],
+                          drop_empty: bool, entity_chunks: Set[ChunkPos]) -> bool:
+        if chunk_box is not None:
+            min_x, min_z, max_x, max_z = chunk_box
+            if not (min_x <= pos[0] <= max_x and min_z <= pos[1] <= max_z):
+                return False
+        if pos in entity_chunks:
+            return True
+        try:
+            data = chunk.load()
+        except (OSError, zlib.error, NbtError) as exc:
+            debug_log(f'Chunk {pos} is unreadable and kept: {exc}')
+            return True
+        if data is None:
+            return True
+        # Chunk data is wrapped in "Level" before 1.18
+        level = data.get('Level', data)
+        status = str(level.get('Status', 'full')).replace('minecraft:', '')
+        if status != 'full':
+            return False
+        if drop_empty and self.is_chunk_empty(level):
+            return False
+        return level.get('InhabitedTime', 0) >= config.optimize.min_inhabited_ticks
+
+    @staticmethod
+    def find_dimension_folders(slot_dir: str) -> List[str]:
+        return [root for root, dirs, files in os.walk(slot_dir) if TERRAIN_FOLDER in dirs]
+
+    def optimize_folder(self, folder: str, kept: Optional[Set[ChunkPos]], report: OptimizeReport,
+                        chunk_box: Optional[Tuple[int, int, int, int]], drop_empty: bool = False,
+                        entity_chunks: Set[ChunkPos] = frozenset()) -> Set[ChunkPos]:
+        # Decides by chunk content if kept is None, else keeps exactly the given chunk positions
+        result = set()
+        if not os.path.isdir(folder):
+            return result
+        for file_name in os.listdir(folder):
+            if REGION_FILE_PATTERN.match(file_name) is None:
+                continue
+            path = os.path.join(folder, file_name)
+            size = os.path.getsize(path)
+            report.size_before += size
+            region = RegionFile(path)
+            region.read()
+            removed = []
+            for index, chunk in region.chunks.items():
+                pos = region.chunk_pos(index)
+                if self.is_region_outside(region, chunk_box):
+                    keep = False
+                elif kept is None:
+                    keep = self.should_keep_chunk(chunk, pos, chunk_box, drop_empty, entity_chunks)
+                else:
+                    keep = pos in kept
+                if keep:
+                    result.add(pos)
+                else:
+                    removed.append(index)
+            if kept is None:
+                report.chunks_removed += len(removed)
+                report.chunks_kept += len(region.chunks) - len(removed)
+            all_removed = len(removed) == len(region.chunks)
+            if report.dry_run:
+                report.regions_removed += 1 if all_removed and kept is None else 0
+                continue
+            for index in removed:
+                region.remove_chunk(index)
+            if all_removed:
+                os.remove(path)
+                report.regions_removed += 1
+                continue
+            if len(removed) > 0:
+                region.write()
+            report.size_after += os.path.getsize(path)
+        return result
+
+    def optimize_dir(self, slot_dir: str, report: OptimizeReport):
+        chunk_box = self.get_chunk_box()
+        for dimension in self.find_dimension_folders(slot_dir):
+            debug_log(f'Optimizing dimension folder {dimension}')
+            drop_empty = config.optimize.drop_empty_chunks
+            if drop_empty:
+                generator = self.get_dimension_generator(dimension, slot_dir)
+                drop_empty = generator in EMPTY_GENERATORS
+                if not drop_empty:
+                    debug_log(f'Empty chunks of {dimension} are kept, generator {generator} would fill them')
+            entity_chunks = self.find_entity_chunks(os.path.join(dimension, ENTITIES_FOLDER))
+            kept = self.optimize_folder(
+                os.path.join(dimension, TERRAIN_FOLDER), None, report, chunk_box, drop_empty, entity_chunks
+            )
+            for follower in FOLLOWER_FOLDERS:
+                self.optimize_folder(os.path.join(dimension, follower), kept, report, chunk_box)
+
+    def optimize_slot(self, slot_name: str, dry_run: bool = False) -> OptimizeReport:
+        report, slot_dir = OptimizeReport(slot_name, dry_run), storage.get_slot_full_dir(slot_name)
+        if dry_run:
+            self.optimize_dir(slot_dir, report)
+            return report
+        # Work on a copy, the slot is only replaced once every region file has been rewritten
+        work_dir, replaced_dir = slot_dir + OPTIMIZING_SUFFIX, slot_dir + REPLACED_SUFFIX
+        rm(work_dir)
+        try:
+            shutil.copytree(slot_dir, work_dir, ignore=lambda path, files: [SLOT_INFO_FILE] if path == slot_dir else [])
+            self.optimize_dir(work_dir, report)
+            if os.path.isfile(os.path.join(slot_dir, SLOT_INFO_FILE)):
+                shutil.copy2(os.path.join(slot_dir, SLOT_INFO_FILE), os.path.join(work_dir, SLOT_INFO_FILE))
+        except Exception:
+            rm(work_dir)
+            raise
+        rm(replaced_dir)
+        os.rename(slot_dir, replaced_dir)
+        os.rename(work_dir, slot_dir)
+        rm(replaced_dir)
+        storage.get_slot_manifest(slot_name, refresh=True)
+        return report
+
+    def preview(self, source: CommandSource, slot_name: str):
+        report = self.optimize_slot(slot_name, dry_run=True)
+        source.reply(tr(
+            'msg.optimize.preview', slot=slot_name, chunks=report.chunks_removed, kept=report.chunks_kept,
+            regions=report.regions_removed, size=format_size(report.size_before)
+        ))
+        command = f'{config.primary_prefix} optimize "{slot_name}" confirm'
+        source.reply(tr('msg.optimize.confirm', command).c(RAction.suggest_command, command).h(
+            tr('hover.suggest', command)
+        ))
+
+    def run(self, source: CommandSource, slot_name: str, confirmed: bool = False):
+        if not self.__lock.acquire(blocking=False):
+            source.reply(tr('error.optimize_running'))
+            return
+        try:
+            if not confirmed:
+                self.preview(source, slot_name)
+                return
+            source.reply(tr('msg.optimize.start', slot_name))
+            report = self.optimize_slot(slot_name)
+            source.reply(tr(
+                'msg.optimize.done', slot=slot_name, saved=format_size(report.saved),
+                before=format_size(report.size_before), after=format_size(report.size_after),
+                chunks=report.chunks_removed, kept=report.chunks_kept, regions=report.regions_removed
+            ))
+        except Exception as exc:
+            gl_server.logger.exception(f'Failed to optimize slot {slot_name}')
+            source.reply(tr('error.in_session', str(exc)))
+        finally:
+            self.__lock.release()
+
+
+region_optimizer = RegionOptimizer()
@@ -5,19 +5,26 @@ import time
 
 from abc import ABC
 from datetime import datetime, timedelta
-from apscheduler.triggers.interval import IntervalTrigger
-from apscheduler.triggers.date import DateTrigger
-from apscheduler.job import Job
-from apscheduler.schedulers.background import BackgroundScheduler
-from typing import Dict, List, Callable, Any, Optional, Union, Iterable, Tuple
-from threading import Lock, Thread
+from typing import Dict, List, Callable, Any, Optional, Union, Iterable, Tuple, TYPE_CHECKING
+from threading import Lock, RLock, Thread, Event
+from concurrent.futures import Future
 from mcdreforged.api.rtext import *
 from mcdreforged.api.types import PlayerCommandSource, CommandSource
-from mcdreforged.api.decorator import new_thread
 
-from .utils import debug_log, gl_server, stop_and_wait, rm, cp, tr
-from .storage import storage, SLOT_INFO_FILE, SlotInfo
+from .utils import debug_log, gl_server, stop_and_wait, rm, cp, tr, ign
+from .storage import storage, LiveItem, fingerprint_files, scan_files
 from .config import config
+from .executor import CancellationToken, session_executor
+from .metrics import metrics
+from .players import player_tracker
+from .staging import slot_stager
+from .world_cache import world_cache, ServerProperties
+from .profiler import session_profiler
+from .level import data_version_checker
+
+if TYPE_CHECKING:
+    from apscheduler.job import Job
+    from apscheduler.schedulers.background import BackgroundScheduler
 
 
 VoteOptionDisplayText = Union[str, RTextBase]
@@ -25,6 +32,11 @@ Styles = Union[None, RStyle, Iterable[RStyle]]
 
 
 class VoteOption:
+    __slots__ = (
+        'actual_name', 'display_name', 'display_color', 'colored_display_name', 'display_styles',
+        '__display_text', '__disabled_text'
+    )
+
     def __init__(self, actual_name: str, display_name: Optional[VoteOptionDisplayText] = None,
                  color: Optional[RColor] = None, styles: Styles = None):
         self.actual_name: str = actual_name
@@ -32,17 +44,28 @@ class VoteOption:
         self.display_color: RColor = color if isinstance(color, RColor) else RColor.aqua
         self.colored_display_name = RText(str(self.display_name), self.display_color)
         self.display_styles: Styles = styles
+        self.__display_text: Optional[RTextBase] = None
+        self.__disabled_text: Optional[str] = None
 
     @property
-    def display_text(self):
-        text = self.colored_display_name.copy()
-        if self.display_styles is not None:
-            text.set_styles(self.display_styles)
-        return text.c(
-            RAction.run_command, f'{config.primary_prefix} choose {self.actual_name}'
-        ).h(
-            tr('hover.vote', option=self.colored_display_name)
-        )
+    def display_text(self) -> RTextBase:
+        # Built once, vote board and hover never change during a vote
+        if self.__display_text is None:
+            text = self.colored_display_name.copy()
+            if self.display_styles is not None:
+                text.set_styles(self.display_styles)
+            self.__display_text = text.c(
+                RAction.run_command, f'{config.primary_prefix} choose {self.actual_name}'
+            ).h(
+                tr('hover.vote', option=self.colored_display_name)
+            )
+        return self.__display_text
+
+    @property
+    def disabled_text(self) -> str:
+        if self.__disabled_text is None:
+            self.__disabled_text = f"§7§m{self.display_name}§r"
+        return self.__disabled_text
 
 
 class ExecutorScheduleHandler:
@@ -60,37 +83,52 @@ class ExecutorScheduleHandler:
 
 class AbstractSession:
     __running_sessions = {}
+    __registry_lock = RLock()
     session_global_lock = Lock()
 
     def __init__(self, should_lock: bool = True):
         self.should_lock = should_lock
-        self.terminated = False
+        self.token = CancellationToken()
+        self.worker_thread: Optional[Thread] = None
+
+    @property
+    def terminated(self) -> bool:
+        return self.token.is_cancelled
 
-    def main(self, *args, thread_name: Optional[str] = None, **kwargs) -> Thread:
-        @new_thread(f"MapSwitcher_{str(thread_name) if thread_name is not None else 'BeforeSession'}")
+    def main(self, *args, run_on_worker: bool = False, **kwargs) -> Future:
         def wrapper():
+            self.worker_thread = threading.current_thread()
+
             def wrap():
                 handler = ExecutorScheduleHandler(self.actual_main, *args, **kwargs)
-                if thread_name is None:
+                if not run_on_worker:
                     gl_server.schedule_task(handler.run)
                 else:
                     handler.run()
 
+            # True once actual_main is run or handed to TaskExecutor
             try:
+                if self.terminated:
+                    return False
                 if self.should_lock:
                     with self.session_global_lock:
                         if self.terminated:
-                            return
+                            return False
                         wrap()
                 else:
                     wrap()
+                return True
 
             except Exception as exc:
-                gl_server.logger.exception('Error occurred in VoteSession thread of MapSwitcher')
-                gl_server.say(tr('error.in_session', RText(str(exc), RColor.dark_red)).set_color(RColor.red))
-                self.on_error(exc)
+                self.handle_error(exc)
+                return False
+
+        return session_executor.submit(wrapper)
 
-        return wrapper()
+    def handle_error(self, exc: Exception):
+        gl_server.logger.exception(f'Error occurred in {self.__class__.__name__} of MapSwitcher')
+        gl_server.say(tr('error.in_session', RText(str(exc), RColor.dark_red)).set_color(RColor.red))
+        self.on_error(exc)
 
     def actual_main(self, *args, **kwargs):
         raise NotImplementedError
@@ -100,27 +138,39 @@ class AbstractSession:
 
     @classmethod
     def clear(cls):
-        if cls in cls.__running_sessions.keys():
-            cls.__running_sessions[cls] = None
+        with cls.__registry_lock:
+            if cls in cls.__running_sessions.keys():
+                cls.__running_sessions[cls] = None
 
     @classmethod
     def clear_all(cls):
-        cls.__running_sessions = {}
+        with cls.__registry_lock:
+            AbstractSession.__running_sessions = {}
 
     def interrupt(self):
-        self.terminated = True
+        self.token.cancel()
         self.clear()
 
     @classmethod
     def is_all_empty(cls):
-        return all([session is None for session in cls.__running_sessions.values()])
+        with cls.__registry_lock:
+            return all([session is None for session in cls.__running_sessions.values()])
 
     def set_session(self):
-        self.__running_sessions[self.__class__] = self
+        with self.__registry_lock:
+            self.__running_sessions[self.__class__] = self
+
+    def try_set_session(self) -> bool:
+        with self.__registry_lock:
+            if self.__running_sessions.get(self.__class__) is not None:
+                return False
+            self.__running_sessions[self.__class__] = self
+            return True
 
     @classmethod
     def get_instance(cls):
-        return cls.__running_sessions.get(cls)
+        with cls.__registry_lock:
+            return cls.__running_sessions.get(cls)
 
     @classmethod
     def is_available(cls):
@@ -128,13 +178,15 @@ class AbstractSession:
 
     @classmethod
     def all_sessions(cls):
-        return cls.__running_sessions.copy()
+        with cls.__registry_lock:
+            return cls.__running_sessions.copy()
 
     @classmethod
     def on_unload(cls):
-        for session in cls.__running_sessions.values():
+        for session in cls.all_sessions().values():
             if session is not None:
                 session.interrupt()
+        session_executor.shutdown()
 
 
 class LoadSlotSession(AbstractSession, ABC):
@@ -148,59 +200,180 @@ class LoadSlotSession(AbstractSession, ABC):
         self.moved = []
         self.temp_folder = os.path.join(config.server_path, config.restore_temp_folder)
         self.finished_backup = False
+        self.former_level_name: Optional[str] = None
         self.handle_exc = handle_exc
+        self.started = False
+        # Set once this session is done with the server, whether it switched, got cancelled or failed
+        self.finished = Event()
         if not os.path.isdir(self.slot_dir_path):
             raise FileNotFoundError('This slot is not found')
+        if not storage.is_slot_compatible(slot):
+            raise ValueError(f'Slot {slot} is saved by another game version than the server')
 
     def start(self):
         self.set_session()
-        self.main()
+        self.main().add_done_callback(self.__on_submitted)
 
-    def actual_main(self, *args, **kwargs):
-        if not gl_server.is_on_executor_thread():
-            raise RuntimeError('This function can only be called on TaskExecutor thread')
-        gl_server.broadcast(tr('msg.next_map', self.slot_name))
-        gl_server.broadcast(tr('msg.before_load', config.countdown_time))
-        stop_and_wait(config.countdown_time)
+    def __on_submitted(self, future: Future):
+        # main() gave up before actual_main, nothing else would set finished
+        if future.cancelled() or future.exception() is not None or future.result() is not True:
+            self.finished.set()
 
-        if not os.path.isdir(self.temp_folder):
-            os.makedirs(self.temp_folder)
-            debug_log('Generated temp folder')
+    def cancel(self):
+        # Only effective during the countdown, a switch which stopped the server always runs to the end
+        self.token.cancel()
+        if not self.started:
+            self.finished.set()
 
-        # back world files up
-        for item in config.world_names:
-            cp(os.path.join(config.server_path, item), os.path.join(self.temp_folder, item))
-
-        # remove current world file
-        self.finished_backup = True
-        for item in config.world_names:
-            rm(os.path.join(config.server_path, item))
+    def interrupt(self):
+        super(LoadSlotSession, self).interrupt()
+        if not self.started:
+            self.finished.set()
 
-        # copy file to server directory
-        for item in os.listdir(self.slot_dir_path):
-            if item != SLOT_INFO_FILE:
-                cp(os.path.join(self.slot_dir_path, item), os.path.join(config.server_path, item))
+    def actual_main(self, *args, **kwargs):
+        self.started = True
+        try:
+            session_profiler.run('switch', self.__load)
+        except Exception as exc:
+            # Runs on TaskExecutor, errors would never reach the handler in main()
+            self.handle_error(exc)
+        finally:
+            self.finished.set()
+
+    def __load(self):
+        if not gl_server.is_on_executor_thread():
+            raise RuntimeError('This function can only be called on TaskExecutor thread')
+        if self.terminated:
+            return
+        switch_start = time.time()
+        # Nobody to warn when the server is empty
+        countdown = 0 if player_tracker.is_idle else config.countdown_time
+        if countdown > 0:
+            gl_server.broadcast(tr('msg.next_map', self.slot_name))
+            gl_server.broadcast(tr('msg.before_load', countdown))
+        else:
+            debug_log(f'Server is idle, loading {self.slot_name} without countdown')
+        if not stop_and_wait(countdown, token=self.token):
+            gl_server.broadcast(tr('msg.load_cancelled', self.slot_name))
+            metrics.switches.inc(result='cancelled')
+            return
+        data_version_checker.refresh()
 
-        shutil.rmtree(self.temp_folder)
+        copy_start = time.time()
+        if config.world_cache.enabled:
+            self.__switch_cached_world()
+        else:
+            self.__replace_world_files()
+        metrics.switch_copy_duration.observe(time.time() - copy_start)
 
         LoadSlotSession.current_slot = self.slot_name
         debug_log(f'Current slot: {self.current_slot}')
-        current_info = storage.get_slots_info().get(self.slot_name, SlotInfo.get_default())
-        debug_log(f'Set used time for slot {self.slot_name}')
-        current_info.last_used = time.time()
-        current_info.save(self.slot_name)
         gl_server.start()
+        switch_duration = time.time() - switch_start
+        debug_log(f'Record switch to slot {self.slot_name}')
+        storage.record_switch(self.slot_name, switch_duration)
+        metrics.switches.inc(result='success')
+        metrics.switch_duration.observe(switch_duration)
         rolling: Optional[AutoMapRollingSession] = AutoMapRollingSession.get_instance()
         if rolling is not None:
-            AutoMapRollingSession.get_instance().restart()
+            # Switches not started by auto rolling leave its scheduler running
+            if rolling.is_running:
+                rolling.stop_scheduler()
+            rolling.restart()
         self.clear()
 
+    def __switch_cached_world(self):
+        # Previous world stays on disk as part of the cache, only level-name changes
+        self.former_level_name = ServerProperties(config.server_path).level_name
+        hit = world_cache.switch_to(self.slot_name, slot_stager.take(self.slot_name))
+        debug_log(f'World cache {"hit" if hit else "miss"} for slot {self.slot_name}')
+
+    def __get_changed_items(self) -> Dict[str, str]:
+        # Owned items mapped to their slot fingerprint, minus those still identical to what the server has
+        # Items not indexed yet are copied without hashing, reading them twice would keep the server down longer
+        manifest = storage.get_slot_manifest(self.slot_name, refresh=True)
+        changed = {}
+        for item, fingerprint in storage.get_item_fingerprints(self.slot_name, manifest, compute=False).items():
+            if fingerprint is None:
+                changed[item] = ''
+                continue
+            live = storage.get_live_item(item)
+            if live is not None and live.source_fingerprint == fingerprint and \
+                    os.path.exists(os.path.join(config.server_path, item)) and \
+                    live.live_fingerprint == fingerprint_files(scan_files(config.server_path, item)):
+                debug_log(f'"{item}" is identical to the loaded one, left in place')
+                continue
+            changed[item] = fingerprint
+        return changed
+
+    def __get_leftover_items(self, owned: Iterable[str]) -> List[str]:
+        # World items another slot loaded which this slot doesn't own, the server regenerates them instead
+        # Items the server generated itself have no live record and are shared by every slot
+        leftovers = []
+        for item, live in sorted(storage.get_live_items().items()):
+            if live.slot == self.slot_name or item.split('/', 1)[0] not in config.world_names:
+                continue
+            if any([item == owned_item or item.startswith(owned_item + '/') or owned_item.startswith(item + '/')
+                    for owned_item in owned]):
+                continue
+            if os.path.exists(os.path.join(config.server_path, item)):
+                leftovers.append(item)
+        return leftovers
+
+    def __replace_world_files(self):
+        world_cache.restore_level_name()
+        if not os.path.isdir(self.temp_folder):
+            os.makedirs(self.temp_folder)
+            debug_log('Generated temp folder')
+        changed = self.__get_changed_items()
+        leftovers = self.__get_leftover_items(storage.get_owned_items(self.slot_name))
+        staged_dir = slot_stager.take(self.slot_name)
+
+        # back world files up, a rename within server folder
+        self.finished_backup = True
+        for item in list(changed.keys()) + leftovers:
+            live_path = os.path.join(config.server_path, item)
+            if os.path.exists(live_path):
+                os.makedirs(os.path.dirname(os.path.join(self.temp_folder, item)), exist_ok=True)
+                os.replace(live_path, os.path.join(self.temp_folder, item))
+                self.backed_up.append(item)
+
+        # copy file to server directory, or move the copy staged during the vote in
+        # live items nested in a replaced one are gone along with it
+        storage.forget_live_items(leftovers + [item for item in storage.get_live_items().keys() if any([
+            item == changed_item or item.startswith(changed_item + '/') for changed_item in changed.keys()
+        ])])
+        for item in changed.keys():
+            target_path = os.path.join(config.server_path, item)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            self.moved.append(item)
+            if staged_dir is not None and os.path.exists(os.path.join(staged_dir, item)):
+                os.replace(os.path.join(staged_dir, item), target_path)
+                debug_log(f'Moved staged "{item}" to server folder')
+            else:
+                cp(os.path.join(self.slot_dir_path, item), target_path)
+        if staged_dir is not None:
+            rm(staged_dir)
+        storage.record_live_items({item: LiveItem(
+            slot=self.slot_name, source_fingerprint=fingerprint,
+            live_fingerprint=fingerprint_files(scan_files(config.server_path, item))
+        ) for item, fingerprint in changed.items()})
+        debug_log(f'Loaded {len(changed)} changed item(s) of slot {self.slot_name}: {", ".join(changed.keys())}')
+        if len(leftovers) > 0:
+            debug_log(f'Removed {len(leftovers)} item(s) not owned by slot {self.slot_name}: {", ".join(leftovers)}')
+
+        shutil.rmtree(self.temp_folder)
+
     def on_error(self, exc: Exception):
+        metrics.switches.inc(result='failed')
+        if self.former_level_name is not None:
+            ign(setattr, ServerProperties(config.server_path), 'level_name', self.former_level_name)
         if self.finished_backup:
+            metrics.rollbacks.inc()
             for item in self.moved:
                 rm(os.path.join(config.server_path, item))
             for item in self.backed_up:
-                cp(os.path.join(self.temp_folder, item), os.path.join(config.server_path, item))
+                os.replace(os.path.join(self.temp_folder, item), os.path.join(config.server_path, item))
         if os.path.isdir(self.temp_folder):
             shutil.rmtree(self.temp_folder)
         if not gl_server.is_server_running():
@@ -212,26 +385,32 @@ class LoadSlotSession(AbstractSession, ABC):
 
 class VoteSession(AbstractSession, ABC):
     def __init__(self, initiator: str, vote_options: List[VoteOption], result_handler: Callable[[VoteOption], Any],
-                 target: Union[str, RTextBase], allow_draw: bool = False, handle_on_executor: bool = True):
+                 target: Union[str, RTextBase], allow_draw: bool = False, handle_on_executor: bool = True,
+                 progress_listener: Optional[Callable[['VoteSession'], Any]] = None):
         super(VoteSession, self).__init__()
         self.initiator = initiator
+        self.progress_listener = progress_listener
+        self.winners: List[VoteOption] = []
         self.voted: Dict[str, VoteOption] = dict()
         self.__vote_options: List[VoteOption] = vote_options
         self.__original_options: List[VoteOption] = vote_options
+        self.__option_mapping: Dict[str, VoteOption] = {item.actual_name: item for item in vote_options}
+        self.__tally: Dict[VoteOption, int] = {item: 0 for item in vote_options}
+        self.__tally_version: int = 0
+        self.__sorted_result: Optional[Tuple[int, Dict[VoteOption, int]]] = None
+        self.__board: Optional[Tuple[int, RTextBase]] = None
         self.overtime: int = 0
         self.result_handler = result_handler
         self.handle_on_executor = handle_on_executor
         self.allow_draw = allow_draw
-        self.__thread_lock = Lock()
         self.target: Union[str, RTextBase] = target
-        self.thread: Optional[Thread] = None
+        self.__force_settle = False
 
-        if not self.session_global_lock.locked():
-            with self.__thread_lock:
-                self.thread = self.main(thread_name='VoteSession')
+        if not self.session_global_lock.locked() and self.try_set_session():
+            self.main(run_on_worker=True)
         else:
             gl_server.logger.warning('Already a session running!')
-            self.terminated = True
+            self.token.cancel()
 
     @classmethod
     def is_available_option(cls, actual_option_name: str):
@@ -242,60 +421,87 @@ class VoteSession(AbstractSession, ABC):
 
     @property
     def actual_vote_options(self):
-        return list(self.option_mapping.keys())
+        return list(self.__option_mapping.keys())
+
+    @property
+    def tally_version(self) -> int:
+        return self.__tally_version
 
     @property
-    def vote_options_for_display(self):
-        options = []
+    def vote_options_for_display(self) -> List[Union[str, RTextBase]]:
+        available, disabled = [], []
         for item in self.__original_options:
-            if item in self.__vote_options:
-                options.append(item.display_text)
+            if item.actual_name in self.__option_mapping:
+                available.append(item.display_text)
             else:
-                options.append(f"§7§m{item.display_name}§r")
-        return sorted(options, key=lambda x: 1 if isinstance(x, RTextBase) else 0, reverse=True)
+                disabled.append(item.disabled_text)
+        return available + disabled
 
     def actual_main(self, *args, **kwargs):
-        if not self.is_available():
+        if self.get_instance() is not self:
             raise RuntimeError('There is already a processing vote')
-
-        self.set_session()
-        with self.__thread_lock:
-            self.__wait_and_settle()
+        self.__wait_and_settle()
 
     def start_overtime(self, options: List[VoteOption]):
         debug_log('Overtime starting...')
-        if threading.current_thread() != self.thread:
+        if threading.current_thread() != self.worker_thread:
             raise RuntimeError("Can't be called outside VoteSession thread")
         for item in options:
-            if item not in self.__vote_options:
+            if item.actual_name not in self.__option_mapping:
                 raise IndexError('Illegal overtime option {}: all the options must be included in the former vote')
         self.__vote_options = options
+        self.__option_mapping = {item.actual_name: item for item in options}
+        self.__tally = {item: 0 for item in options}
         self.voted = {}
         self.overtime += 1
+        self.__force_settle = False
+        self.__tally_version += 1
 
         self.__wait_and_settle()
 
     @property
     def option_mapping(self) -> Dict[str, VoteOption]:
-        return {item.actual_name: item for item in self.__vote_options}
+        return self.__option_mapping.copy()
 
     def get_option(self, option_name: str) -> Optional[VoteOption]:
-        return self.option_mapping.get(option_name)
+        return self.__option_mapping.get(option_name)
 
     def vote(self, source: PlayerCommandSource, option: str):
-        if option not in self.actual_vote_options:
+        new_option = self.get_option(option)
+        if new_option is None:
             raise KeyError('Illegal vote option')
-        self.voted[source.player] = self.get_option(option)
+        old_option = self.voted.get(source.player)
+        if old_option is new_option:
+            return
+        if old_option is not None and old_option in self.__tally:
+            self.__tally[old_option] -= 1
+        self.__tally[new_option] += 1
+        self.voted[source.player] = new_option
+        self.__tally_version += 1
+        self.notify_progress()
+
+    def notify_progress(self):
+        if self.progress_listener is None:
+            return
+        try:
+            self.progress_listener(self)
+        except Exception:
+            gl_server.logger.exception('Error occurred in vote progress listener of MapSwitcher')
+
+    def interrupt(self):
+        was_terminated = self.terminated
+        super(VoteSession, self).interrupt()
+        if not was_terminated:
+            self.notify_progress()
 
     @property
     def vote_result(self) -> Dict[VoteOption, int]:
-        result = {}
-        for item in self.__vote_options:
-            result[item] = 0
-        for value in self.voted.values():
-            result[value] += 1
-        sorted_result: List[Tuple[VoteOption, int]] = sorted(list(result.items()), key=lambda x: x[1], reverse=True)
-        return {item[0]: item[1] for item in sorted_result}    # fuck u pycharm
+        cached = self.__sorted_result
+        if cached is None or cached[0] != self.__tally_version:
+            sorted_result = sorted(self.__tally.items(), key=lambda x: x[1], reverse=True)
+            cached = self.__tally_version, {item[0]: item[1] for item in sorted_result}
+            self.__sorted_result = cached
+        return cached[1]
 
     def result_text(self, winners):
         text_list, num = [tr('msg.vote.result', ', '.join([f"§a{item.display_name}§r" for item in winners]))], 0
@@ -304,25 +510,28 @@ class VoteSession(AbstractSession, ABC):
             c1, c2 = ('a', "2") if option in winners else ('c§m', "4§m")
             text_list.append(f'[§e{num}§r] §{c2}{result}§r §{c1}{option.display_name}§r')
         for option in self.__original_options:
-            if option not in self.__vote_options:
+            if option.actual_name not in self.__option_mapping:
                 num += 1
                 text_list.append(f'[§e{num}§r] §7§m-- {option.display_name}')
         return RText.join('\n', text_list)
 
     @property
     def display_text(self):
-        num = 0
-        overtime_text = tr('msg.vote.overtime', self.overtime) if self.overtime > 0 else ''
-        to_display = [
-            tr('msg.vote.headline', target=self.target,
-               player=self.initiator, vote_time=config.vote_time_limit, overtime=overtime_text)
-        ]
-
-        for option in self.vote_options_for_display:
-            num += 1
-            to_display.append(f'[§3{num}§r] ' + option)
+        # Board only changes when an overtime round starts
+        if self.__board is None or self.__board[0] != self.overtime:
+            num = 0
+            overtime_text = tr('msg.vote.overtime', self.overtime) if self.overtime > 0 else ''
+            to_display = [
+                tr('msg.vote.headline', target=self.target,
+                   player=self.initiator, vote_time=config.vote_time_limit, overtime=overtime_text)
+            ]
+
+            for option in self.vote_options_for_display:
+                num += 1
+                to_display.append(f'[§3{num}§r] ' + option)
 
-        return RTextBase.join('\n', to_display)
+            self.__board = self.overtime, RTextBase.join('\n', to_display)
+        return self.__board[1]
 
     def display_to_source(self, source: CommandSource):
         source.reply(self.display_text)
@@ -331,34 +540,49 @@ class VoteSession(AbstractSession, ABC):
         # Ensure current thread
         if gl_server.is_on_executor_thread():
             raise RuntimeError("Vote can't start on TaskExecutor thread")
-        if self.thread != threading.current_thread():
+        if self.worker_thread != threading.current_thread():
             raise RuntimeError("Unexpected call from other threads")
 
         # Announce vote start
         gl_server.say(self.display_text)
 
-        # Wait for vote ends
-        time.sleep(config.vote_time_limit * 60)
+        # Wait for vote ends, settle command wakes this thread up in advance
+        self.token.wait(config.vote_time_limit * 60)
         if not self.terminated:
-            self.settle()
+            session_profiler.run('vote', self.__settle, self.__force_settle)
 
     def settle(self, force: bool = False):
+        if threading.current_thread() != self.worker_thread:
+            self.__force_settle = force
+            self.token.notify()
+            return
+        session_profiler.run('vote', self.__settle, force)
+
+    def __settle(self, force: bool = False):
         # Handle result
-        max_value, winners = list(self.vote_result.values())[0], []
-        for key, value in self.vote_result.items():
+        vote_result = self.vote_result
+        max_value, winners = list(vote_result.values())[0], []
+        for key, value in vote_result.items():
             if value == max_value:
                 winners.append(key)
 
-        if sum(self.vote_result.values()) == 0:
+        if sum(vote_result.values()) == 0:
             gl_server.say(tr('msg.vote.no_one').set_color(RColor.red))
+            metrics.votes.inc(result='no_one')
             self.interrupt()
 
         if self.terminated:
             return
 
+        metrics.vote_participants.observe(len(self.voted))
+        if player_tracker.online_amount > 0:
+            metrics.vote_participation.set(len(self.voted) / player_tracker.online_amount)
+
         gl_server.say(self.result_text(winners))
 
         if len(winners) == 1 or self.allow_draw:
+            metrics.votes.inc(result='decided')
+            self.winners = winners
             self.interrupt()
             if self.handle_on_executor:
                 handler = ExecutorScheduleHandler(self.result_handler, *winners)
@@ -366,6 +590,7 @@ class VoteSession(AbstractSession, ABC):
             else:
                 self.result_handler(*winners)
         elif len(winners) > 1:
+            metrics.vote_overtimes.inc()
             if force:
                 self.interrupt()
             self.start_overtime(winners)
@@ -373,6 +598,7 @@ class VoteSession(AbstractSession, ABC):
             raise RuntimeError('Result handle error: Empty winner')
 
     def on_error(self, exc: Exception):
+        metrics.votes.inc(result='error')
         self.interrupt()
 
 
@@ -380,17 +606,28 @@ class AutoMapRollingSession(AbstractSession, ABC):
     __last_rolling_start: Optional[datetime] = None
     __next_rolling: Optional[datetime] = None
 
-    def __init__(self, roller: Callable[[], Any]):
+    def __init__(self, roller: Callable[[], Any], clock: Optional[Tuple[datetime, datetime]] = None):
         super(AutoMapRollingSession, self).__init__(False)
         self.__roller = roller
-        self.__last_rolling_start = datetime.now()
-        self.__next_rolling = self.__last_rolling_start + timedelta(minutes=config.map_rolling_interval)
-        self.__scheduler: Optional[BackgroundScheduler] = None
-        self.__remind_jobs: Optional[Job] = None
-        self.__roll_job: Optional[Job] = None
+        self.__interval = config.map_rolling_interval
+        self.__remind_interval = config.remind_rolling_interval
+        if clock is None:
+            self.__last_rolling_start = datetime.now()
+            self.__next_rolling = self.__last_rolling_start + timedelta(minutes=self.__interval)
+        else:
+            # Handed over by a former instance of this plugin
+            self.__last_rolling_start, self.__next_rolling = clock
+        self.__scheduler: Optional['BackgroundScheduler'] = None
+        self.__remind_jobs: Optional['Job'] = None
+        self.__roll_job: Optional['Job'] = None
         self.__init_scheduler()
 
     def __init_scheduler(self):
+        # APScheduler is only imported when auto rolling is actually enabled
+        from apscheduler.triggers.interval import IntervalTrigger
+        from apscheduler.triggers.date import DateTrigger
+        from apscheduler.schedulers.background import BackgroundScheduler
+
         try:
             self.__roll_job.remove()
         except:
@@ -409,14 +646,38 @@ class AutoMapRollingSession(AbstractSession, ABC):
         self.__scheduler = BackgroundScheduler(daemon=True)
         self.__remind_jobs = self.__scheduler.add_job(
             self.remind,
-            IntervalTrigger(seconds=round(timedelta(minutes=config.remind_rolling_interval).total_seconds()))
+            IntervalTrigger(seconds=round(timedelta(minutes=self.__remind_interval).total_seconds()))
         )
         self.__roll_job = self.__scheduler.add_job(
-            self.__roll, DateTrigger(run_date=self.__next_rolling),
+            self.__roll, DateTrigger(run_date=max(self.__next_rolling, datetime.now())),
         )
         self.__scheduler.start()
 
+    def reschedule(self):
+        # Apply changed intervals on the running scheduler, time elapsed and delays voted so far are kept
+        from apscheduler.triggers.interval import IntervalTrigger
+        from apscheduler.triggers.date import DateTrigger
+
+        if not self.is_running:
+            return
+        if config.map_rolling_interval != self.__interval:
+            self.__next_rolling += timedelta(minutes=config.map_rolling_interval - self.__interval)
+            self.__interval = config.map_rolling_interval
+            self.__roll_job.reschedule(DateTrigger(run_date=max(self.__next_rolling, datetime.now())))
+            debug_log(f'Next rolling rescheduled to {self.__next_rolling}')
+        if config.remind_rolling_interval != self.__remind_interval:
+            self.__remind_interval = config.remind_rolling_interval
+            self.__remind_jobs.reschedule(
+                IntervalTrigger(seconds=round(timedelta(minutes=self.__remind_interval).total_seconds()))
+            )
+            debug_log(f'Remind interval rescheduled to {self.__remind_interval} min(s)')
+
+    @property
+    def clock(self) -> Tuple[datetime, datetime]:
+        return self.__last_rolling_start, self.__next_rolling
+
     def __roll(self):
+        metrics.rolling_lateness.observe(abs((datetime.now() - self.__next_rolling).total_seconds()))
         gl_server.schedule_task(self.main)
 
     def delay(self, minutes: int):
@@ -425,16 +686,13 @@ class AutoMapRollingSession(AbstractSession, ABC):
         debug_log(f'Old next rolling time: {self.__next_rolling}')
         self.__next_rolling += delay_time
         debug_log(f'Current next rolling time: {self.__next_rolling}')
+        metrics.rolling_delays.inc()
+        if minutes > 0:
+            metrics.rolling_delay_minutes.inc(minutes)
 
         if self.__next_rolling.timestamp() < time.time():
             gl_server.say(tr('msg.delay.not_enough'))
             return
-
-        if not self.is_running:
-            load_session = LoadSlotSession.get_instance()
-            if load_session is None:
-                raise RuntimeError("Can't delay a finished session")
-            load_session.interrupt()
         self.__init_scheduler()
 
     def actual_main(self, *args, **kwargs):
@@ -444,12 +702,22 @@ class AutoMapRollingSession(AbstractSession, ABC):
         self.__roller()
 
     def remind(self):
+        if player_tracker.is_idle:
+            return
         if abs((datetime.now() - self.__next_rolling).total_seconds()) < 1:
             return
         remaining = self.get_remaining_time()
         remaining = round(remaining / 60, 2)
         gl_server.say(tr('msg.remind', remaining))
 
+    def on_idle(self):
+        if config.idle_rolling_after < 0 or not self.is_running:
+            return
+        if (datetime.now() - self.__last_rolling_start).total_seconds() < config.idle_rolling_after * 60:
+            return
+        debug_log('Server is idle, rolling map in advance')
+        gl_server.schedule_task(self.main)
+
     def get_remaining_time(self) -> float:
         return (self.__next_rolling - datetime.now()).total_seconds()
 
@@ -475,3 +743,18 @@ class AutoMapRollingSession(AbstractSession, ABC):
     def on_error(self, exc: Exception):
         self.interrupt()
         self.restart()
+
+
+def roll_when_idle():
+    rolling: Optional[AutoMapRollingSession] = AutoMapRollingSession.get_instance()
+    if rolling is not None:
+        rolling.on_idle()
+
+
+def rolling_remaining_seconds() -> Optional[float]:
+    rolling: Optional[AutoMapRollingSession] = AutoMapRollingSession.get_instance()
+    return rolling.get_remaining_time() if rolling is not None else None
+
+
+metrics.rolling_remaining.set_function(rolling_remaining_seconds)
+metrics.online_players.set_function(lambda: player_tracker.online_amount if player_tracker.is_synced else None)
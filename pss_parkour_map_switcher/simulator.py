@@ -0,0 +1,162 @@
+import math
+import random
+import statistics
+import time
+
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Dict, List, Optional
+from mcdreforged.api.types import CommandSource
+
+from .config import config
+from .storage import StorageManager, Catalog, SlotInfo
+from .utils import tr, gl_server
+
+
+class VirtualClock:
+    def __init__(self, start: datetime):
+        self.start = start
+        self.now = start
+
+    def advance_to(self, target: datetime):
+        if target > self.now:
+            self.now = target
+
+    @property
+    def timestamp(self) -> float:
+        return self.now.timestamp()
+
+
+class SimulationReport:
+    def __init__(self, rotations: int, slots: int):
+        self.rotations = rotations
+        self.slots = slots
+        self.picks: Dict[str, int] = {}
+        self.repeats = 0
+        self.repeat_window = 0
+        self.reminds = 0
+        self.delays = 0
+        self.selection_costs: List[float] = []
+        self.scheduler_costs: List[float] = []
+        self.virtual_time = timedelta()
+        self.wall_time = 0.0
+
+    @property
+    def never_picked(self) -> int:
+        return self.slots - len([item for item in self.picks.values() if item > 0])
+
+    @property
+    def fairness(self) -> float:
+        # Coefficient of variation of picks per slot, 0 is perfectly even
+        counts = [self.picks.get(f'sim_{num}', 0) for num in range(self.slots)]
+        mean = statistics.fmean(counts)
+        return statistics.pstdev(counts) / mean if mean > 0 else 0
+
+    @property
+    def repeat_rate(self) -> float:
+        return self.repeats / self.rotations if self.rotations > 0 else 0
+
+    @staticmethod
+    def micro_seconds(costs: List[float], percentile: Optional[float] = None) -> float:
+        if len(costs) == 0:
+            return 0
+        if percentile is None:
+            return round(statistics.fmean(costs) * 1e6, 2)
+        index = min(len(costs) - 1, math.ceil(len(costs) * percentile) - 1)
+        return round(sorted(costs)[index] * 1e6, 2)
+
+
+class RotationSimulator:
+    def __init__(self):
+        self.__lock = Lock()
+
+    @staticmethod
+    def build_storage(slots: int, clock: VirtualClock) -> StorageManager:
+        catalog = Catalog.get_default()
+        catalog.slots = {}
+        for num in range(slots):
+            slot_info = SlotInfo.get_default()
+            # Spread initial usage over the past so the pool starts out of order, like a real catalog
+            slot_info.last_used = clock.timestamp - random.uniform(0, config.map_rolling_interval * 60 * slots)
+            catalog.slots[f'sim_{num}'] = slot_info
+        return StorageManager(catalog)
+
+    @staticmethod
+    def schedule_rotation(clock: VirtualClock, next_rolling: datetime, report: SimulationReport) -> datetime:
+        # Same triggers AutoMapRollingSession puts on its scheduler, evaluated against the virtual clock
+        from apscheduler.triggers.interval import IntervalTrigger
+        from apscheduler.triggers.date import DateTrigger
+
+        start_time = time.perf_counter()
+        remind_trigger = IntervalTrigger(
+            seconds=round(timedelta(minutes=config.remind_rolling_interval).total_seconds()),
+            start_date=clock.now, timezone=clock.now.tzinfo
+        )
+        roll_time = DateTrigger(run_date=next_rolling, timezone=clock.now.tzinfo).get_next_fire_time(None, clock.now)
+        fire_time = remind_trigger.get_next_fire_time(None, clock.now)
+        while fire_time is not None and fire_time < roll_time:
+            report.reminds += 1
+            fire_time = remind_trigger.get_next_fire_time(fire_time, fire_time)
+        report.scheduler_costs.append(time.perf_counter() - start_time)
+        return roll_time
+
+    def simulate(self, rotations: int, slots: int, delay_chance: float = 0.0) -> SimulationReport:
+        from apscheduler.util import astimezone
+
+        report, wall_start = SimulationReport(rotations, slots), time.perf_counter()
+        # A timezone APScheduler accepts on every 3.x release
+        clock = VirtualClock(datetime.now(astimezone('UTC')))
+        sim_storage = self.build_storage(slots, clock)
+        report.repeat_window = max(sim_storage.get_random_slots_amount() - 1, 1)
+        history: List[str] = []
+        current: Optional[str] = None
+        for _ in range(rotations):
+            next_rolling = clock.now + timedelta(minutes=config.map_rolling_interval)
+            if random.random() < delay_chance:
+                next_rolling += timedelta(minutes=config.default_delay_single_time)
+                report.delays += 1
+            clock.advance_to(self.schedule_rotation(clock, next_rolling, report))
+
+            start_time = time.perf_counter()
+            current, slot_info = sim_storage.random_a_slot(current)
+            report.selection_costs.append(time.perf_counter() - start_time)
+
+            if current in history[-report.repeat_window:]:
+                report.repeats += 1
+            history.append(current)
+            report.picks[current] = report.picks.get(current, 0) + 1
+            sim_storage.record_switch(current, 0, now=clock.timestamp)
+        report.virtual_time = clock.now - clock.start
+        report.wall_time = time.perf_counter() - wall_start
+        return report
+
+    def run(self, source: CommandSource, rotations: int, slots: int, delay_chance: float):
+        if not self.__lock.acquire(blocking=False):
+            source.reply(tr('error.simulation_running'))
+            return
+        try:
+            if rotations <= 0 or slots <= 1:
+                source.reply(tr('error.invalid_simulation'))
+                return
+            source.reply(tr('msg.simulate.start', rotations=rotations, slots=slots))
+            report = self.simulate(rotations, slots, delay_chance)
+            source.reply(tr(
+                'msg.simulate.done', rotations=report.rotations, slots=report.slots,
+                virtual_days=round(report.virtual_time.total_seconds() / 86400, 1),
+                wall=round(report.wall_time, 2), fairness=round(report.fairness, 3),
+                min_picks=min([report.picks.get(f'sim_{num}', 0) for num in range(slots)]),
+                max_picks=max(report.picks.values()), never=report.never_picked,
+                repeat=round(report.repeat_rate * 100, 2), window=report.repeat_window,
+                pick_avg=report.micro_seconds(report.selection_costs),
+                pick_p99=report.micro_seconds(report.selection_costs, 0.99),
+                scheduler=report.micro_seconds(report.scheduler_costs),
+                reminds=report.reminds, delays=report.delays
+            ))
+        except Exception as exc:
+            gl_server.logger.exception('Rotation simulation failed')
+            source.reply(tr('error.in_session', str(exc)))
+        finally:
+            self.__lock.release()
+
+
+rotation_simulator = RotationSimulator()
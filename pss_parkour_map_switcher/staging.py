@@ -0,0 +1,150 @@
+import os
+import shutil
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import RLock, Event
+from typing import Dict, List, Optional
+
+from .config import config
+from .executor import CancellationToken
+from .storage import storage, SLOT_INFO_FILE
+from .utils import gl_server, debug_log, rm
+
+
+class StagingCancelled(Exception):
+    pass
+
+
+class StagedSlot:
+    def __init__(self, slot_name: str, path: str, size: int):
+        self.slot_name = slot_name
+        self.path = path
+        self.size = size
+        self.token = CancellationToken()
+        self.finished = Event()
+        self.error: Optional[Exception] = None
+
+    @property
+    def is_ready(self):
+        return self.finished.is_set() and self.error is None
+
+    def copy(self):
+        source_dir = storage.get_slot_full_dir(self.slot_name)
+        start_time = time.time()
+        try:
+            for root, dirs, files in os.walk(source_dir):
+                relative_root = os.path.relpath(root, source_dir)
+                target_root = os.path.normpath(os.path.join(self.path, relative_root))
+                dirs[:] = [item for item in dirs if not config.is_file_ignored(item)]
+                os.makedirs(target_root, exist_ok=True)
+                for name in files:
+                    if self.token.is_cancelled:
+                        raise StagingCancelled(f'Staging of slot {self.slot_name} is cancelled')
+                    if config.is_file_ignored(name) or (relative_root == '.' and name == SLOT_INFO_FILE):
+                        continue
+                    shutil.copy2(os.path.join(root, name), os.path.join(target_root, name))
+            debug_log(f'Staged slot {self.slot_name} in {round(time.time() - start_time, 2)} s')
+        except Exception as exc:
+            self.error = exc
+            if not isinstance(exc, StagingCancelled):
+                gl_server.logger.exception(f'Failed to stage slot {self.slot_name}')
+            rm(self.path)
+        finally:
+            self.finished.set()
+
+    def discard(self):
+        self.token.cancel()
+        self.finished.wait()
+        rm(self.path)
+        debug_log(f'Discarded staged slot {self.slot_name}')
+
+
+class SlotStager:
+    def __init__(self):
+        self.__lock = RLock()
+        self.__staged: Dict[str, StagedSlot] = {}
+        self.__pool: Optional[ThreadPoolExecutor] = None
+        self.__serial = 0
+
+    @staticmethod
+    def get_staging_dir():
+        # Inside server folder so staged files can be moved in with a rename
+        return os.path.join(config.server_path, config.staging.folder)
+
+    @property
+    def staged_size(self) -> int:
+        with self.__lock:
+            return sum([item.size for item in self.__staged.values()])
+
+    def __submit(self, staged: StagedSlot):
+        if self.__pool is None:
+            self.__pool = ThreadPoolExecutor(
+                max_workers=config.staging.max_staged_slots, thread_name_prefix='MapSwitcher_Staging'
+            )
+        self.__pool.submit(staged.copy)
+
+    def retain(self, slots: List[str]):
+        if not config.staging.enabled:
+            return
+        slots, slots_info = slots[:config.staging.max_staged_slots], storage.get_slots_info()
+        with self.__lock:
+            for slot_name in list(self.__staged.keys()):
+                if slot_name not in slots:
+                    self.__discard_later(self.__staged.pop(slot_name))
+            for slot_name in slots:
+                if slot_name in self.__staged or not os.path.isdir(storage.get_slot_full_dir(slot_name)):
+                    continue
+                # Votes report progress often, sizing a slot must never walk its folder
+                slot_info = slots_info.get(slot_name)
+                if slot_info is None or slot_info.size is None:
+                    debug_log(f'Slot {slot_name} is not staged, it is not indexed yet')
+                    continue
+                size = slot_info.size
+                if self.staged_size + size > config.staging.budget_mb * 2 ** 20:
+                    debug_log(f'Slot {slot_name} is not staged, staging budget exceeded')
+                    continue
+                # Discarded copies of the same slot may still be removing, never reuse their folder
+                self.__serial += 1
+                staged_path = os.path.join(self.get_staging_dir(), f'{slot_name}.{self.__serial}')
+                staged = StagedSlot(slot_name, staged_path, size)
+                self.__staged[slot_name] = staged
+                self.__submit(staged)
+                debug_log(f'Staging slot {slot_name}')
+
+    def __discard_later(self, staged: StagedSlot):
+        staged.token.cancel()
+        self.__pool.submit(staged.discard)
+
+    def discard(self, slot_name: str):
+        with self.__lock:
+            staged = self.__staged.pop(slot_name, None)
+            if staged is not None:
+                self.__discard_later(staged)
+
+    def take(self, slot_name: str) -> Optional[str]:
+        with self.__lock:
+            staged = self.__staged.pop(slot_name, None)
+        if staged is None:
+            return None
+        # Copy of the winner is already running, finishing it is never slower than starting over
+        staged.finished.wait()
+        return staged.path if staged.is_ready else None
+
+    def discard_all(self):
+        with self.__lock:
+            staged_slots, self.__staged = list(self.__staged.values()), {}
+        for staged in staged_slots:
+            staged.discard()
+        rm(self.get_staging_dir())
+
+    def shutdown(self):
+        with self.__lock:
+            for staged in self.__staged.values():
+                staged.token.cancel()
+            if self.__pool is not None:
+                self.__pool.shutdown(wait=False)
+                self.__pool = None
+
+
+slot_stager = SlotStager()
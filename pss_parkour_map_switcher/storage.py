@@ -1,22 +1,49 @@
 import datetime
+import fnmatch
+import hashlib
 import json
 import os
 import random
+import time
 
-from typing import Optional, Dict, Tuple
+from typing import Optional, Dict, Tuple, List, Callable, Any
 from threading import RLock
 from mcdreforged.api.utils import Serializable
 
 from .config import config
-from .utils import gl_server
+from .level import LevelMeta, load_level_meta, data_version_checker
+from .utils import gl_server, debug_log
+from .metrics import metrics
 
 
 SLOT_INFO_FILE = 'info.json'
+CATALOG_FILE = 'catalog.json'
+CATALOG_VERSION = 1
+HASH_BLOCK_SIZE = 2 ** 20
+SORT_KEYS: Dict[str, Callable[[Tuple[str, 'SlotInfo']], Any]] = {
+    'name': lambda item: item[0].lower(),
+    'size': lambda item: 0 if item[1].size is None else item[1].size,
+    'last_used': lambda item: item[1].last_used_time,
+    'play_count': lambda item: item[1].play_count,
+}
+
+
+class ItemFingerprint(Serializable):
+    stat: str = ''  # of paths, sizes and mtimes of the files hashed, content is rehashed once it changes
+    content: str = ''
 
 
 class SlotInfo(Serializable):
     last_used: Optional[float] = None
     comment: str = ''
+    play_count: int = 0  # times switched to, total_switch_duration is spread over these
+    total_play_time: float = 0  # second(s)
+    total_switch_duration: float = 0  # second(s)
+    size: Optional[int] = None
+    level: Optional[LevelMeta] = None
+    # Top-level items or relative paths like "world/DIM-1" this slot replaces on switch, detected if None
+    owned_items: Optional[List[str]] = None
+    fingerprints: Dict[str, ItemFingerprint] = {}
 
     @property
     def last_used_time(self) -> int:
@@ -26,13 +53,20 @@ class SlotInfo(Serializable):
     def last_used_formatted(self) -> str:
         return datetime.datetime.fromtimestamp(self.last_used_time).strftime('%Y-%m-%d %H:%M:%S')
 
+    @property
+    def average_switch_duration(self) -> float:
+        return self.total_switch_duration / self.play_count if self.play_count > 0 else 0
+
+    @property
+    def total_play_time_formatted(self) -> str:
+        return str(datetime.timedelta(seconds=round(self.total_play_time)))
+
     def save(self, folder_name: str):
-        gl_server.save_config_simple(
-            self, file_name=os.path.join(config.backup_path, folder_name, SLOT_INFO_FILE), in_data_folder=False
-        )
+        storage.update_slot(folder_name, self)
 
     @classmethod
     def load(cls, folder_name: str) -> Optional['SlotInfo']:
+        # Legacy per-slot info.json, only read to migrate into the catalog
         folder_path = os.path.join(config.backup_path, folder_name)
         if not os.path.isdir(folder_path):
             return None
@@ -45,9 +79,96 @@ class SlotInfo(Serializable):
             return None
 
 
+class LiveItem(Serializable):
+    slot: str = ''
+    source_fingerprint: str = ''  # content of the slot files it was loaded from
+    live_fingerprint: str = ''  # of the server files right after loading, changes once the server writes to it
+
+
+class Catalog(Serializable):
+    version: int = CATALOG_VERSION
+    current_slot: Optional[str] = None
+    current_since: Optional[float] = None
+    slots: Dict[str, SlotInfo] = {}
+    live_items: Dict[str, LiveItem] = {}
+
+
+def fingerprint_files(files: Dict[str, Tuple[int, float]]) -> str:
+    digest = hashlib.sha1()
+    for path in sorted(files.keys()):
+        size, mtime = files[path]
+        digest.update(f'{path}\0{size}\0{mtime}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def hash_files(root_dir: str, files: Dict[str, Tuple[int, float]]) -> str:
+    # Slots sharing an item share this whenever the files were copied or touched
+    digest = hashlib.sha1()
+    for path in sorted(files.keys()):
+        digest.update(f'{path}\0{files[path][0]}\n'.encode('utf-8'))
+        with open(os.path.join(root_dir, path), 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_files(root_dir: str, item: str) -> Dict[str, Tuple[int, float]]:
+    # Same layout as SlotManifest.files, limited to one item under root_dir
+    files, item_path = {}, os.path.join(root_dir, item)
+    if os.path.isfile(item_path):
+        stat = os.stat(item_path)
+        return {item: (stat.st_size, stat.st_mtime)}
+    for root, dirs, file_names in os.walk(item_path):
+        # session.lock and alike are written by a running server and never copied
+        dirs[:] = [name for name in dirs if not config.is_file_ignored(name)]
+        for name in file_names:
+            if config.is_file_ignored(name):
+                continue
+            full_path = os.path.join(root, name)
+            stat = os.stat(full_path)
+            files[os.path.relpath(full_path, root_dir).replace(os.sep, '/')] = (stat.st_size, stat.st_mtime)
+    return files
+
+
+class SlotManifest:
+    def __init__(self, files: Dict[str, Tuple[int, float]]):
+        # relative path with '/' separator -> (size, mtime)
+        self.files = files
+        self.size = sum([item[0] for item in files.values()])
+        self.indexed_time = time.time()
+
+    @property
+    def top_level_items(self) -> List[str]:
+        return sorted(set([item.split('/', 1)[0] for item in self.files.keys()]))
+
+    def get_item_files(self, item: str) -> Dict[str, Tuple[int, float]]:
+        prefix = item + '/'
+        return {key: value for key, value in self.files.items() if key == item or key.startswith(prefix)}
+
+    @classmethod
+    def build(cls, slot_dir: str) -> 'SlotManifest':
+        files = {}
+        for root, dirs, file_names in os.walk(slot_dir):
+            for name in file_names:
+                full_path = os.path.join(root, name)
+                stat = os.stat(full_path)
+                files[os.path.relpath(full_path, slot_dir).replace(os.sep, '/')] = (stat.st_size, stat.st_mtime)
+        files.pop(SLOT_INFO_FILE, None)
+        return cls(files)
+
+
 class StorageManager:
-    def __init__(self):
+    def __init__(self, catalog: Optional[Catalog] = None):
         self.__lock = RLock()
+        self.__manifests: Dict[str, SlotManifest] = {}
+        # A catalog given here is kept in memory only, used by the rotation simulator
+        self.__catalog: Optional[Catalog] = catalog
+        self.__persistent = catalog is None
+        self.__sorted_slots: Optional[List[Tuple[str, SlotInfo]]] = None
+        # Slot names by sort key, rebuilt lazily after the catalog changes
+        self.__list_indexes: Dict[str, List[str]] = {}
+        # Changes left for the end of a batch, see index_slots()
+        self.__unsaved = False
 
     @staticmethod
     def get_backup_dir():
@@ -58,21 +179,149 @@ class StorageManager:
     def get_slot_full_dir(self, folder: str):
         return os.path.join(self.get_backup_dir(), folder)
 
+    def get_catalog_path(self):
+        return os.path.join(self.get_backup_dir(), CATALOG_FILE)
+
+    @property
+    def catalog(self) -> Catalog:
+        with self.__lock:
+            if self.__catalog is None:
+                self.__catalog = self.__load_catalog()
+            return self.__catalog
+
+    def __load_catalog(self) -> Catalog:
+        catalog_path = self.get_catalog_path()
+        if os.path.isfile(catalog_path):
+            try:
+                with open(catalog_path, 'r', encoding='UTF-8') as f:
+                    return Catalog.deserialize(json.load(f))
+            except Exception:
+                gl_server.logger.exception(f'Failed to read slot catalog {catalog_path}, rebuilding it')
+        catalog = Catalog.get_default()
+        catalog.slots = self.__scan_legacy_slots()
+        gl_server.logger.info(f'Migrated {len(catalog.slots)} slot(s) from {SLOT_INFO_FILE} into {CATALOG_FILE}')
+        self.__save_catalog(catalog)
+        return catalog
+
+    def __scan_legacy_slots(self) -> Dict[str, SlotInfo]:
+        slots = {}
+        for folder in os.listdir(self.get_backup_dir()):
+            this_slot_info = SlotInfo.load(folder)
+            if this_slot_info is not None:
+                slots[folder] = this_slot_info
+        return slots
+
+    def __save_catalog(self, catalog: Optional[Catalog] = None):
+        catalog = self.catalog if catalog is None else catalog
+        catalog_path = self.get_catalog_path()
+        temp_path = f'{catalog_path}.tmp'
+        with open(temp_path, 'w', encoding='UTF-8') as f:
+            json.dump(catalog.serialize(), f, indent=4, ensure_ascii=False)
+        os.replace(temp_path, catalog_path)
+
+    def __on_catalog_changed(self, save: bool = True):
+        self.__sorted_slots = None
+        self.__list_indexes = {}
+        self.__unsaved = not save
+        if save and self.__persistent:
+            self.__save_catalog()
+
+    def reset(self):
+        # Forget everything read from backup_path, the catalog is read again on next access
+        with self.__lock:
+            if self.__persistent:
+                self.__catalog = None
+            self.__manifests.clear()
+            self.__sorted_slots = None
+            self.__list_indexes = {}
+
+    def rescan(self):
+        # Picks up slot folders added by hand and forgets removed ones
+        with self.__lock:
+            scan_start = time.time()
+            slots, changed = self.catalog.slots, False
+            for slot_name, slot_info in self.__scan_legacy_slots().items():
+                if slot_name not in slots:
+                    slots[slot_name] = slot_info
+                    changed = True
+                    debug_log(f'Found new slot {slot_name}')
+            for slot_name in list(slots.keys()):
+                if not os.path.isdir(self.get_slot_full_dir(slot_name)):
+                    del slots[slot_name]
+                    self.__manifests.pop(slot_name, None)
+                    changed = True
+                    debug_log(f'Slot {slot_name} removed from catalog')
+            if changed:
+                self.__on_catalog_changed()
+            if self.__persistent:
+                metrics.catalog_scans.inc()
+                metrics.catalog_scan_duration.observe(time.time() - scan_start)
+                metrics.catalog_slots.set(len(slots))
+        self.refresh_level_meta()
+
+    def refresh_level_meta(self, slot_names: Optional[List[str]] = None) -> int:
+        # Parses level.dat of slots whose copy changed, the catalog is saved once for the whole batch
+        with self.__lock:
+            slots = self.catalog.slots
+            targets = [(name, slots[name].level) for name in (slots.keys() if slot_names is None else slot_names)
+                       if name in slots]
+        parsed = {}
+        for slot_name, cached in targets:
+            meta = load_level_meta(self.get_slot_full_dir(slot_name), cached)
+            if meta is not cached:
+                parsed[slot_name] = meta
+        if len(parsed) > 0:
+            with self.__lock:
+                for slot_name, meta in parsed.items():
+                    slot_info = self.catalog.slots.get(slot_name)
+                    if slot_info is not None:
+                        slot_info.level = meta
+                self.__on_catalog_changed()
+            debug_log(f'Parsed level.dat of {len(parsed)} slot(s)')
+        return len(parsed)
+
+    def update_slot(self, slot_name: str, slot_info: SlotInfo):
+        with self.__lock:
+            self.catalog.slots[slot_name] = slot_info
+            self.__on_catalog_changed()
+
+    @property
+    def current_slot(self) -> Optional[str]:
+        return self.catalog.current_slot
+
+    def record_switch(self, slot_name: str, switch_duration: float, now: Optional[float] = None):
+        with self.__lock:
+            catalog, now = self.catalog, time.time() if now is None else now
+            former = catalog.slots.get(catalog.current_slot) if catalog.current_slot is not None else None
+            if former is not None and catalog.current_since is not None:
+                former.total_play_time += max(now - catalog.current_since, 0)
+            slot_info = catalog.slots.setdefault(slot_name, SlotInfo.get_default())
+            slot_info.last_used = now
+            slot_info.play_count += 1
+            slot_info.total_switch_duration += switch_duration
+            catalog.current_slot, catalog.current_since = slot_name, now
+            self.__on_catalog_changed()
+
     def get_slots_info(self, reverse: bool = False) -> Dict[str, SlotInfo]:
         with self.__lock:
-            slot_info_mapping = dict()
-            for folder in os.listdir(self.get_backup_dir()):
-                this_slot_dir = self.get_slot_full_dir(folder)
-                if os.path.isdir(this_slot_dir) and SLOT_INFO_FILE in os.listdir(this_slot_dir):
-                    this_slot_info = SlotInfo.load(folder)
-                    if this_slot_info is not None:
-                        slot_info_mapping[folder] = this_slot_info
-            slot_info_mapping = {
-                item[0]: item[1] for item in sorted(
-                    list(slot_info_mapping.copy().items()), key=lambda item: item[1].last_used_time, reverse=reverse
-                )
-            }
-            return slot_info_mapping
+            if self.__sorted_slots is None:
+                self.__sorted_slots = sorted(self.catalog.slots.items(), key=lambda item: item[1].last_used_time)
+            sorted_slots = reversed(self.__sorted_slots) if reverse else self.__sorted_slots
+            return {item[0]: item[1] for item in sorted_slots}
+
+    def list_slots(self, sort: str = 'last_used', reverse: bool = False, keyword: Optional[str] = None) -> List[str]:
+        with self.__lock:
+            index = self.__list_indexes.get(sort)
+            if index is None:
+                index = [item[0] for item in sorted(self.catalog.slots.items(), key=SORT_KEYS[sort])]
+                self.__list_indexes[sort] = index
+        result = index[::-1] if reverse else index
+        if keyword is None or keyword == '':
+            return result
+        keyword = keyword.lower()
+        if any([char in keyword for char in '*?[']):
+            return [item for item in result if fnmatch.fnmatchcase(item.lower(), keyword)]
+        return [item for item in result if keyword in item.lower()]
 
     def get_slots_amount(self):
         with self.__lock:
@@ -86,17 +335,108 @@ class StorageManager:
 
     def get_random_slots(self):
         with self.__lock:
-            slots_info = self.get_slots_info()
-            if self.get_slots_amount() <= self.get_random_slots_amount():
+            # Incompatible slots are never used, they would hold the least recently used places forever
+            slots_info = {key: value for key, value in self.get_slots_info().items() if self.is_slot_compatible(key)}
+            if len(slots_info) <= self.get_random_slots_amount():
                 return slots_info
             return {item: slots_info[item] for item in list(slots_info.keys())[:self.get_random_slots_amount()]}
 
+    def get_level_meta(self, slot_name: str) -> Optional[LevelMeta]:
+        # Indexed by rescan() and index_slots(), never touches the disk
+        with self.__lock:
+            slot_info = self.catalog.slots.get(slot_name)
+            return None if slot_info is None else slot_info.level
+
+    def is_slot_compatible(self, slot_name: str) -> bool:
+        # Catalogs kept in memory only hold made up slots, there is no world to compare with
+        if not self.__persistent:
+            return True
+        return data_version_checker.is_compatible(self.get_level_meta(slot_name))
+
+    def get_owned_items(self, slot_name: str, manifest: Optional[SlotManifest] = None) -> List[str]:
+        slot_info = self.catalog.slots.get(slot_name)
+        if slot_info is not None and slot_info.owned_items is not None:
+            return [item.strip('/') for item in slot_info.owned_items if item.strip('/') != '']
+        manifest = self.get_slot_manifest(slot_name) if manifest is None else manifest
+        return [item for item in manifest.top_level_items if not config.is_file_ignored(item)]
+
+    def get_item_fingerprints(self, slot_name: str, manifest: Optional[SlotManifest] = None,
+                              compute: bool = True, save: bool = True) -> Dict[str, Optional[str]]:
+        # Content fingerprints of owned items, only items whose files changed since last time are hashed again
+        # None for items not hashed yet if compute is False, they are left to idle indexing
+        manifest = self.get_slot_manifest(slot_name) if manifest is None else manifest
+        with self.__lock:
+            slot_info = self.catalog.slots.get(slot_name)
+            cached = {} if slot_info is None else slot_info.fingerprints.copy()
+        slot_dir, result, updated = self.get_slot_full_dir(slot_name), {}, False
+        for item in self.get_owned_items(slot_name, manifest):
+            files = manifest.get_item_files(item)
+            stat = fingerprint_files(files)
+            if item not in cached or cached[item].stat != stat:
+                if not compute:
+                    result[item] = None
+                    continue
+                cached[item] = ItemFingerprint(stat=stat, content=hash_files(slot_dir, files))
+                updated = True
+            result[item] = cached[item].content
+        if updated or (compute and len(cached) != len(result)):
+            with self.__lock:
+                slot_info = self.catalog.slots.get(slot_name)
+                if slot_info is not None:
+                    slot_info.fingerprints = {item: cached[item] for item in result.keys() if item in cached}
+                    self.__on_catalog_changed(save)
+        return result
+
+    def get_live_item(self, item: str) -> Optional[LiveItem]:
+        with self.__lock:
+            return self.catalog.live_items.get(item)
+
+    def get_live_items(self) -> Dict[str, LiveItem]:
+        with self.__lock:
+            return self.catalog.live_items.copy()
+
+    def record_live_items(self, live_items: Dict[str, LiveItem]):
+        with self.__lock:
+            self.catalog.live_items.update(live_items)
+            self.__on_catalog_changed()
+
+    def forget_live_items(self, items: List[str]):
+        with self.__lock:
+            for item in items:
+                self.catalog.live_items.pop(item, None)
+            self.__on_catalog_changed()
+
+    def get_slot_manifest(self, slot_name: str, refresh: bool = False, save: bool = True) -> SlotManifest:
+        manifest = self.__manifests.get(slot_name)
+        if manifest is None or refresh:
+            manifest = SlotManifest.build(self.get_slot_full_dir(slot_name))
+            self.__manifests[slot_name] = manifest
+            with self.__lock:
+                slot_info = self.catalog.slots.get(slot_name)
+                if slot_info is not None and slot_info.size != manifest.size:
+                    slot_info.size = manifest.size
+                    self.__on_catalog_changed(save)
+        return manifest
+
+    def index_slots(self):
+        for slot_name in self.get_slots_info().keys():
+            if slot_name not in self.__manifests:
+                self.get_item_fingerprints(slot_name, self.get_slot_manifest(slot_name, save=False), save=False)
+                debug_log(f'Indexed slot {slot_name}')
+        # Sizes and fingerprints of the whole batch are saved at once, along with level.dat metadata if any
+        self.refresh_level_meta()
+        with self.__lock:
+            if self.__unsaved:
+                self.__on_catalog_changed()
+
     def get_slot_size(self, slot_name: str):
-        dir_ = self.get_slot_full_dir(slot_name)
-        size = 0
-        for root, dirs, files in os.walk(dir_):
-            size += sum([os.path.getsize(os.path.join(root, name)) for name in files])
-        return size
+        manifest = self.__manifests.get(slot_name)
+        if manifest is not None:
+            return manifest.size
+        slot_info = self.catalog.slots.get(slot_name)
+        if slot_info is not None and slot_info.size is not None:
+            return slot_info.size
+        return self.get_slot_manifest(slot_name).size
 
     def random_a_slot(self, *except_slots: str) -> Tuple[str, SlotInfo]:
         with self.__lock:
@@ -104,6 +444,8 @@ class StorageManager:
             for item in except_slots:
                 if item in slots.keys():
                     del slots[item]
+            if len(slots) == 0:
+                raise RuntimeError('No slot compatible with the server to switch to')
             return random.choice(list(slots.items()))  # fuck u pycharm
 
 
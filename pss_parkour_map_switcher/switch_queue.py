@@ -0,0 +1,189 @@
+import time
+
+from enum import IntEnum
+from threading import Condition, Thread
+from typing import Dict, Optional, List
+from mcdreforged.api.rtext import RText, RColor
+
+from .storage import storage
+from .metrics import metrics
+from .sessions import LoadSlotSession, VoteSession, AutoMapRollingSession
+from .staging import slot_stager
+from .utils import gl_server, debug_log, tr
+
+
+class SwitchPriority(IntEnum):
+    AUTO = 0
+    VOTE = 1
+    ADMIN = 2
+
+
+class SwitchRequest:
+    __slots__ = ('priority', 'slot_name', 'requester', 'submitted')
+
+    def __init__(self, priority: SwitchPriority, slot_name: Optional[str] = None, requester: Optional[str] = None):
+        self.priority = priority
+        # None lets the dispatcher pick a random slot, which is what auto rolling asks for
+        self.slot_name = slot_name
+        self.requester = requester
+        self.submitted = time.time()
+
+    def covers(self, other: 'SwitchRequest') -> bool:
+        return other.slot_name is None or other.slot_name == self.slot_name
+
+    def __repr__(self):
+        return f'SwitchRequest[{self.priority.name}, slot={self.slot_name}, requester={self.requester}]'
+
+
+class SwitchQueue:
+    def __init__(self):
+        self.__condition = Condition()
+        self.__pending: Dict[SwitchPriority, SwitchRequest] = {}
+        self.__current: Optional[SwitchRequest] = None
+        self.__current_session: Optional[LoadSlotSession] = None
+        self.__dispatcher: Optional[Thread] = None
+        self.__stopped = False
+
+    @property
+    def depth(self) -> int:
+        with self.__condition:
+            return len(self.__pending)
+
+    @property
+    def pending(self) -> List[SwitchRequest]:
+        with self.__condition:
+            return sorted(self.__pending.values(), key=lambda item: item.priority, reverse=True)
+
+    @property
+    def current(self) -> Optional[SwitchRequest]:
+        return self.__current
+
+    def submit(self, request: SwitchRequest) -> bool:
+        # False if an equal or stronger request already covers this one
+        with self.__condition:
+            if self.__stopped:
+                return False
+            if self.__current is not None and self.__current.covers(request):
+                self.__drop(request, 'coalesced', self.__current)
+                return False
+            for pending in self.__pending.values():
+                if pending.priority >= request.priority and pending.covers(request):
+                    self.__drop(request, 'coalesced', pending)
+                    return False
+            former = self.__pending.get(request.priority)
+            if former is not None:
+                self.__drop(former, 'superseded', request)
+            self.__pending[request.priority] = request
+            metrics.switch_requests.inc(priority=request.priority.name.lower(), result='queued')
+            debug_log(f'Queued {request}')
+            # A switch still counting down gives way, the server hasn't been stopped yet
+            if self.__current is not None and request.priority >= self.__current.priority:
+                self.__current_session.cancel()
+            self.__ensure_dispatcher()
+            self.__condition.notify_all()
+            return True
+
+    @staticmethod
+    def __drop(request: SwitchRequest, result: str, kept: SwitchRequest):
+        metrics.switch_requests.inc(priority=request.priority.name.lower(), result=result)
+        # Votes stage their winner, the copy is of no use once another slot is switched to instead
+        if request.priority == SwitchPriority.VOTE and request.slot_name is not None and \
+                request.slot_name != kept.slot_name:
+            slot_stager.discard(request.slot_name)
+
+    def withdraw(self, priority: SwitchPriority) -> bool:
+        with self.__condition:
+            withdrawn_request = self.__pending.pop(priority, None)
+            withdrawn = withdrawn_request is not None
+            if withdrawn and priority == SwitchPriority.VOTE and withdrawn_request.slot_name is not None:
+                slot_stager.discard(withdrawn_request.slot_name)
+            if self.__current is not None and self.__current.priority == priority:
+                self.__current_session.cancel()
+                withdrawn = True
+            self.__condition.notify_all()
+            return withdrawn
+
+    def __ensure_dispatcher(self):
+        if self.__dispatcher is None or not self.__dispatcher.is_alive():
+            self.__dispatcher = Thread(target=self.__dispatch_loop, name='MapSwitcher_SwitchQueue', daemon=True)
+            self.__dispatcher.start()
+
+    def __next_request(self) -> Optional[SwitchRequest]:
+        with self.__condition:
+            while True:
+                if self.__stopped:
+                    return None
+                if len(self.__pending) == 0:
+                    self.__condition.wait()
+                    continue
+                request = self.__pending[max(self.__pending.keys())]
+                # Auto rolling waits for running votes, they may end up asking for a switch themselves
+                if request.priority == SwitchPriority.AUTO and VoteSession.get_instance() is not None:
+                    self.__condition.wait(1)
+                    continue
+                # One switch satisfies every weaker request queued meanwhile
+                for pending in self.__pending.values():
+                    if pending is not request:
+                        self.__drop(pending, 'superseded', request)
+                self.__pending.clear()
+                return request
+
+    def __dispatch_loop(self):
+        while True:
+            request = self.__next_request()
+            if request is None:
+                return
+            metrics.switch_queue_wait.observe(time.time() - request.submitted)
+            try:
+                self.__dispatch(request)
+            except Exception as exc:
+                gl_server.logger.exception(f'Failed to dispatch {request}')
+                metrics.switch_requests.inc(priority=request.priority.name.lower(), result='failed')
+                gl_server.broadcast(tr(
+                    'error.switch_failed', request.slot_name or tr('msg.random_slot'), RText(str(exc), RColor.dark_red)
+                ).set_color(RColor.red))
+            finally:
+                with self.__condition:
+                    self.__current, self.__current_session = None, None
+                # Queued behind whatever withdrew the request, e.g. a delay vote still rescheduling rolling
+                gl_server.schedule_task(self.__resume_rolling)
+
+    @staticmethod
+    def __resume_rolling():
+        # Rolling stops its scheduler before asking for a switch, a switch that never happened must not end it
+        rolling: Optional[AutoMapRollingSession] = AutoMapRollingSession.get_instance()
+        if rolling is None:
+            return
+        if rolling.is_running:
+            rolling.reschedule()
+        else:
+            rolling.restart()
+            debug_log('Auto rolling resumed after a switch request ended without switching')
+
+    def __dispatch(self, request: SwitchRequest):
+        slot_name = request.slot_name
+        if slot_name is None:
+            slot_name, slot_info = storage.random_a_slot(LoadSlotSession.current_slot)
+        session = LoadSlotSession(slot_name, handle_exc=False, should_lock=request.priority == SwitchPriority.AUTO)
+        with self.__condition:
+            if self.__stopped:
+                return
+            self.__current, self.__current_session = request, session
+        if request.priority == SwitchPriority.AUTO and LoadSlotSession.session_global_lock.locked():
+            gl_server.broadcast(tr('msg.paused'))
+        debug_log(f'Dispatching {request} to slot {slot_name}')
+        metrics.switch_requests.inc(priority=request.priority.name.lower(), result='dispatched')
+        session.start()
+        while not session.finished.wait(1):
+            if self.__stopped:
+                return
+
+    def stop(self):
+        with self.__condition:
+            self.__stopped = True
+            self.__pending.clear()
+            self.__condition.notify_all()
+
+
+switch_queue = SwitchQueue()
+metrics.switch_queue_depth.set_function(lambda: switch_queue.depth)
@@ -3,16 +3,17 @@ import os
 import shutil
 import time
 
-from mcdreforged.api.types import ServerInterface, PluginServerInterface, CommandSource, PlayerCommandSource
+from mcdreforged.api.types import CommandSource, PlayerCommandSource
 from mcdreforged.api.rtext import *
-from typing import Union, Optional, Callable, Any
+from typing import Union, Optional, Callable, Any, TYPE_CHECKING
 
-from .config import config
+from .config import config, gl_server
+
+if TYPE_CHECKING:
+    from .executor import CancellationToken
 
 
 DEBUG = True
-gl_server: PluginServerInterface = ServerInterface.get_instance().as_plugin_server_interface()
-meta = gl_server.get_self_metadata()
 TRANSLATION_KEY_PREFIX = "mapswitch"
 
 
@@ -57,17 +58,28 @@ def rm(this_file: str, allow_not_found=True):
             raise FileNotFoundError(f'File not found: {this_file}')
 
 
-def stop_and_wait(countdown: int = 5, stop_command: str = None):
+def stop_and_wait(countdown: int = 5, stop_command: str = None, token: Optional['CancellationToken'] = None) -> bool:
     if not gl_server.is_on_executor_thread():
         raise RuntimeError('This function can only be called on TaskExecutor thread')
     for num in range(0, countdown):
         gl_server.broadcast(tr('msg.countdown', countdown - num).set_color(RColor.red))
-        time.sleep(1)
+        if token is None:
+            time.sleep(1)
+        elif token.wait(1) and token.is_cancelled:
+            return False
     if stop_command is None:
         gl_server.stop()
     else:
         gl_server.execute(stop_command)
     gl_server.wait_for_start()
+    return True
+
+
+def format_size(size: int):
+    if size < 2 ** 30:
+        return f'{round(size / 2 ** 20, 2)} §6MB'
+    else:
+        return f'{round(size / 2 ** 30, 2)} §6GB'
 
 
 def src_name(source: CommandSource):
@@ -0,0 +1,186 @@
+import os
+import re
+import time
+
+from threading import RLock
+from typing import Dict, Optional, List
+from mcdreforged.api.utils import Serializable
+
+from .config import config
+from .storage import storage, SLOT_INFO_FILE
+from .metrics import metrics
+from .utils import gl_server, debug_log, cp, rm
+
+
+SERVER_PROPERTIES = 'server.properties'
+LEVEL_NAME_KEY = 'level-name'
+CACHE_STATE_FILE = 'world_cache.json'
+
+
+class ServerProperties:
+    def __init__(self, server_path: str):
+        self.path = os.path.join(server_path, SERVER_PROPERTIES)
+
+    def __read_lines(self) -> List[str]:
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path, 'r', encoding='UTF-8') as f:
+            return f.read().splitlines()
+
+    def get(self, key: str) -> Optional[str]:
+        for line in self.__read_lines():
+            if not line.lstrip().startswith('#') and '=' in line:
+                this_key, value = line.split('=', 1)
+                if this_key.strip() == key:
+                    return value.strip()
+        return None
+
+    def set(self, key: str, value: str):
+        lines, found = self.__read_lines(), False
+        for index, line in enumerate(lines):
+            if not line.lstrip().startswith('#') and '=' in line and line.split('=', 1)[0].strip() == key:
+                lines[index] = f'{key}={value}'
+                found = True
+        if not found:
+            lines.append(f'{key}={value}')
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='UTF-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.path)
+
+    @property
+    def level_name(self) -> str:
+        value = self.get(LEVEL_NAME_KEY)
+        return config.world_names[0] if value is None or value == '' else value
+
+    @level_name.setter
+    def level_name(self, value: str):
+        if not os.path.isfile(self.path):
+            raise FileNotFoundError(f'{SERVER_PROPERTIES} not found in {os.path.dirname(self.path)}')
+        if self.get(LEVEL_NAME_KEY) != value:
+            self.set(LEVEL_NAME_KEY, value)
+            debug_log(f'Set {LEVEL_NAME_KEY} to {value}')
+
+
+class CachedWorld(Serializable):
+    level_name: str = ''
+    folders: List[str] = []
+    size: int = 0
+    last_used: float = 0
+
+
+class WorldCacheState(Serializable):
+    worlds: Dict[str, CachedWorld] = {}
+
+
+class WorldCache:
+    def __init__(self):
+        self.__lock = RLock()
+        self.__state: Optional[WorldCacheState] = None
+
+    @property
+    def state(self) -> WorldCacheState:
+        with self.__lock:
+            if self.__state is None:
+                self.__state = gl_server.load_config_simple(
+                    CACHE_STATE_FILE, default_config={'worlds': {}}, target_class=WorldCacheState, echo_in_console=False
+                )
+            return self.__state
+
+    def __save(self):
+        gl_server.save_config_simple(self.state, CACHE_STATE_FILE)
+
+    @staticmethod
+    def get_level_name(slot_name: str) -> str:
+        return config.world_cache.prefix + re.sub(r'[^\w\-.]', '_', slot_name)
+
+    @staticmethod
+    def map_item_name(item: str, level_name: str) -> Optional[str]:
+        # world -> <level>, world_nether -> <level>_nether, anything else is not a world folder
+        primary = config.world_names[0]
+        if item == primary:
+            return level_name
+        if item.startswith(primary + '_'):
+            return level_name + item[len(primary):]
+        return None
+
+    def is_cached(self, slot_name: str) -> bool:
+        with self.__lock:
+            world = self.state.worlds.get(slot_name)
+            return world is not None and all(
+                [os.path.isdir(os.path.join(config.server_path, item)) for item in world.folders]
+            )
+
+    @property
+    def cached_size(self) -> int:
+        with self.__lock:
+            return sum([item.size for item in self.state.worlds.values()])
+
+    def __materialize(self, slot_name: str, staged_dir: Optional[str]) -> CachedWorld:
+        level_name = self.get_level_name(slot_name)
+        source_dir = staged_dir if staged_dir is not None else storage.get_slot_full_dir(slot_name)
+        world = CachedWorld(level_name=level_name, folders=[], size=storage.get_slot_size(slot_name))
+        for item in os.listdir(source_dir):
+            if item == SLOT_INFO_FILE:
+                continue
+            target_name = self.map_item_name(item, level_name)
+            # Files shared by all worlds, like the legacy switch does
+            target_name = item if target_name is None else target_name
+            target_path = os.path.join(config.server_path, target_name)
+            rm(target_path)
+            if staged_dir is not None:
+                os.replace(os.path.join(source_dir, item), target_path)
+            else:
+                cp(os.path.join(source_dir, item), target_path)
+            if target_name != item:
+                world.folders.append(target_name)
+        if staged_dir is not None:
+            rm(staged_dir)
+        debug_log(f'Materialized slot {slot_name} as {level_name}')
+        return world
+
+    def __evict(self, keep: str):
+        budget = config.world_cache.budget_mb * 2 ** 20
+        lru = sorted(self.state.worlds.items(), key=lambda item: item[1].last_used)
+        for slot_name, world in lru:
+            if self.cached_size <= budget:
+                break
+            if slot_name == keep:
+                continue
+            for folder in world.folders:
+                rm(os.path.join(config.server_path, folder))
+            del self.state.worlds[slot_name]
+            metrics.world_cache_evictions.inc()
+            debug_log(f'Evicted cached world of slot {slot_name}')
+
+    def switch_to(self, slot_name: str, staged_dir: Optional[str] = None) -> bool:
+        # Server must be stopped. Returns whether the slot was already materialized
+        with self.__lock:
+            hit = self.is_cached(slot_name)
+            if hit:
+                if staged_dir is not None:
+                    rm(staged_dir)
+                world = self.state.worlds[slot_name]
+            else:
+                old_world = self.state.worlds.pop(slot_name, None)
+                if old_world is not None:
+                    for folder in old_world.folders:
+                        rm(os.path.join(config.server_path, folder))
+                world = self.__materialize(slot_name, staged_dir)
+                self.state.worlds[slot_name] = world
+            world.last_used = time.time()
+            ServerProperties(config.server_path).level_name = world.level_name
+            self.__evict(keep=slot_name)
+            self.__save()
+            metrics.world_cache_lookups.inc(result='hit' if hit else 'miss')
+            return hit
+
+    @staticmethod
+    def restore_level_name():
+        # Legacy switching loads into world_names, so level-name must point back there
+        properties = ServerProperties(config.server_path)
+        if os.path.isfile(properties.path) and properties.level_name != config.world_names[0]:
+            properties.level_name = config.world_names[0]
+
+
+world_cache = WorldCache()